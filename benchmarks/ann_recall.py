@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Recall@k versus latency for the memory index tiers on a synthetic corpus.
+
+Builds each FAISS index kind used by ``guardian.llm`` over clustered random
+vectors shaped like MiniLM sentence embeddings, then measures recall@k
+against an exact flat scan and the mean latency of one-at-a-time queries
+(the way mentions hit the index).
+
+Usage::
+
+    python benchmarks/ann_recall.py --count 200000 --queries 500
+
+Reference runs on a single core, k=5, 300 queries, default spread:
+
+    200k x 384            recall@5   ms/query   build s
+    flat                     1.000      30.78       0.0
+    ivf_flat nprobe=16       0.998       0.87      73.7
+    ivf_flat nprobe=32       0.999       1.48      73.7
+    ivf_pq   nprobe=32       0.455       0.54     108.0
+    hnsw     efSearch=64     0.930       0.33      78.4
+    hnsw     efSearch=128    0.967       0.70      78.4
+
+    50k x 384 (sparser)   recall@5   ms/query
+    flat                     1.000       8-15
+    ivf_flat nprobe=16       0.923       1.26
+    ivf_flat nprobe=32       0.958       2.27
+    hnsw     efSearch=128    0.999       2.13
+
+A flat scan costs ~30 ms per query at 200k remories, which is where the
+index switches to IVF-Flat. nprobe=32 is the default because on sparser
+corpora it buys 3-4 points of recall over nprobe=16 while staying 20x
+faster than a scan. IVF-PQ recall is poor on these vectors, so it is only
+used past 2M remories where float32 storage becomes the constraint.
+HNSW (opt-in) searches fastest but builds slowest and can't delete.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guardian.llm import build_faiss_index, configure_search  # noqa: E402
+
+
+def synthetic_corpus(count, dim, clusters, spread, seed=0):
+    """Unit vectors drawn around random centroids, like topical chat text."""
+    rng = np.random.default_rng(seed)
+    centroids = rng.normal(size=(clusters, dim)).astype("float32")
+    labels = rng.integers(0, clusters, size=count)
+    vectors = centroids[labels] + spread * rng.normal(size=(count, dim)).astype("float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def measure(index, queries, truth, k):
+    found = []
+    started = time.perf_counter()
+    for query in queries:
+        _, idx = index.search(query[None, :], k)
+        found.append(idx[0])
+    elapsed = time.perf_counter() - started
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / (k * len(queries)), 1000 * elapsed / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--clusters", type=int, default=2000)
+    parser.add_argument("--spread", type=float, default=1.5,
+                        help="Noise around each centroid; higher overlaps topics more")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    vectors = synthetic_corpus(args.count + args.queries, args.dim, args.clusters, args.spread)
+    corpus, queries = vectors[:args.count], vectors[args.count:]
+    ids = np.arange(args.count, dtype="int64")
+
+    exact = build_faiss_index(corpus, ids, "flat")
+    _, truth = exact.search(queries, args.k)
+
+    sweeps = [
+        ("flat", "-", [None]),
+        ("ivf_flat", "nprobe", [4, 8, 16, 32, 64]),
+        ("ivf_pq", "nprobe", [8, 16, 32]),
+        ("hnsw", "efSearch", [16, 32, 64, 128]),
+    ]
+    print(f"{'kind':<10} {'param':<15} {'recall@' + str(args.k):>9} {'ms/query':>10} {'build s':>9}")
+    for kind, param, values in sweeps:
+        started = time.perf_counter()
+        index = exact if kind == "flat" else build_faiss_index(corpus, ids, kind)
+        build = time.perf_counter() - started
+        for value in values:
+            if value is not None:
+                configure_search(index, kind, nprobe=value, ef_search=value)
+            recall, latency = measure(index, queries, truth, args.k)
+            label = "-" if value is None else f"{param}={value}"
+            print(f"{kind:<10} {label:<15} {recall:>9.3f} {latency:>10.2f} {build:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
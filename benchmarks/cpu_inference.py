@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Load time, resident memory and tokens/sec for the CPU inference modes.
+
+Each mode from ``HELMHUD_CPU_MODE`` (plus the default placement) is loaded
+in a fresh subprocess so resident memory isn't shared between runs. The
+model then generates a fixed number of tokens for a mention-shaped prompt
+after one warm-up generation.
+
+Usage::
+
+    python benchmarks/cpu_inference.py --modes default int8 bf16 --tokens 64
+
+Thread counts come from ``HELMHUD_TORCH_THREADS`` and
+``HELMHUD_TORCH_INTEROP_THREADS`` as they do in the bot.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+PROMPT = (
+    "You are Helmhud Guardian, a helpful Discord bot. "
+    "Respond to the user based on the conversation and memories.\n\n"
+    "### Recent Conversation:\nalice: has anyone tried the new StarCode?\n"
+    "bob: 🔥🌟 yes, it unlocked the lab\n\n"
+    "### Influential Memories:\nThe StarForge Lab opens with 💡⚡🔍\n\n"
+    "### User Query:\nWhat does the 🔥🌟 chain do?\n\n### Reply:\n"
+)
+
+
+def resident_mb():
+    """Current resident set size in MB, falling back to the peak."""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode, tokens):
+    """Measure one mode in this process and return its numbers."""
+    from guardian import hf_backend
+
+    hf_backend._load_tokenizer()
+    started = time.perf_counter()
+    model = hf_backend.load_causal_lm("" if mode == "default" else mode)
+    load_seconds = time.perf_counter() - started
+
+    inputs = hf_backend._tokenizer(PROMPT, return_tensors="pt").to(model.device)
+    inputs = {k: v for k, v in inputs.items() if k != "token_type_ids"}
+    model.generate(**inputs, max_new_tokens=8, min_new_tokens=8)
+    started = time.perf_counter()
+    output = model.generate(**inputs, max_new_tokens=tokens, min_new_tokens=tokens)
+    elapsed = time.perf_counter() - started
+    generated = output.shape[1] - inputs["input_ids"].shape[1]
+    return {
+        "mode": mode,
+        "load_seconds": load_seconds,
+        "rss_mb": resident_mb(),
+        "tokens_per_second": generated / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["default", "int8", "bf16"])
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_mode(args.worker, args.tokens)))
+        return
+
+    results = []
+    for mode in args.modes:
+        proc = subprocess.run(
+            [sys.executable, __file__, "--worker", mode, "--tokens", str(args.tokens)],
+            capture_output=True, text=True,
+        )
+        if proc.returncode:
+            print(f"{mode}: failed\n{proc.stderr.strip()}", file=sys.stderr)
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    baseline = next((r for r in results if r["mode"] == "default"), None)
+    print(f"{'mode':<8} {'load s':>8} {'RSS MB':>9} {'tok/s':>7} {'speedup':>8}")
+    for r in results:
+        speedup = (
+            f"{r['tokens_per_second'] / baseline['tokens_per_second']:.2f}x" if baseline else "-"
+        )
+        print(
+            f"{r['mode']:<8} {r['load_seconds']:>8.1f} {r['rss_mb']:>9.0f} "
+            f"{r['tokens_per_second']:>7.2f} {speedup:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
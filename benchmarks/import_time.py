@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Import-time profile of the bot package.
+
+Imports the bot as ``helmhud_guardian.py`` does, in a fresh ``python -X
+importtime`` subprocess, and reports wall time, resident memory, the
+slowest top-level packages by cumulative import time, and whether any of
+the heavy dependencies that should only load on first use (the model
+libraries, FAISS, Pillow, python-magic and bleach) were imported anyway.
+
+Usage::
+
+    python benchmarks/import_time.py --top 15
+
+``--raw FILE`` also writes the full ``-X importtime`` log, which tools such
+as tuna can render.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Deferred until the first mention, warm-up or report with attachments
+DEFERRED = (
+    "torch", "transformers", "sentence_transformers", "faiss", "PIL", "magic", "bleach",
+)
+
+CHILD = f"""
+import json, resource, sys, time
+sys.path.insert(0, {ROOT!r})
+started = time.perf_counter()
+from guardian.bot import bot
+from guardian import utils, events, commands, llm
+seconds = time.perf_counter() - started
+print(json.dumps({{
+    "seconds": seconds,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "loaded": [m for m in {DEFERRED!r} if m in sys.modules],
+}}))
+"""
+
+
+def parse_importtime(log):
+    """Return {top-level package: cumulative microseconds} from an importtime log."""
+    packages = defaultdict(int)
+    for line in log.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        # The outermost import of a package carries its whole cost
+        top = name.split(".")[0]
+        packages[top] = max(packages[top], int(fields[1]))
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--raw", help="Write the full -X importtime log here")
+    args = parser.parse_args()
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD],
+        capture_output=True, text=True,
+    )
+    if args.raw:
+        with open(args.raw, "w", encoding="utf-8") as f:
+            f.write(proc.stderr)
+    if proc.returncode:
+        print(proc.stderr.strip().splitlines()[-1], file=sys.stderr)
+        sys.exit(proc.returncode)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    print(f"import bot: {result['seconds']:.2f}s, peak RSS {result['rss_mb']:.0f} MB")
+    print(f"\n{'package':<28} {'cumulative ms':>14}")
+    packages = parse_importtime(proc.stderr)
+    for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<28} {us / 1000:>14.1f}")
+    print("\ndeferred dependencies imported at startup:", ", ".join(result["loaded"]) or "none")
+    if result["loaded"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
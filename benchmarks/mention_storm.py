@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Aggregate generation throughput for a storm of simultaneous mentions.
+
+Submits ``--mentions`` mention-shaped prompts from different users at once
+through ``guardian.llm.GenerationScheduler`` and reports wall time, replies
+per minute and generated tokens/sec for each batch size, so unbatched
+decoding (batch size 1) can be compared with batched decoding.
+
+Usage::
+
+    python benchmarks/mention_storm.py --mentions 8 --batch-sizes 1 4 8 --tokens 64
+
+``--model`` swaps in a smaller causal LM for quick runs; the bot's own
+model, CPU mode and thread settings are used by default. Only the chat
+model is loaded. It also reports how long a mention that arrives alone
+takes with and without the batching window (median of 3).
+``--backend stub`` measures the scheduler alone: the stub's decoding speeds
+up exactly in proportion to batch size by design, so it can't show a real
+batching gain.
+
+Reference runs on a single Xeon core, 8 mentions, 64 tokens, float32,
+GPT-2-shaped models with random weights (decoding cost doesn't depend on
+the weights; the bot's 5B model doesn't fit this host's 5 GB of RAM):
+
+    124M (12 x 768)     tok/s   speedup      355M (24 x 1024)   tok/s   speedup
+    batch 1             17.11     1.00x      batch 1             5.82     1.00x
+    batch 4             26.27     1.54x      batch 4             7.93     1.36x
+    batch 8             41.20     2.41x      batch 8            11.91     2.05x
+    lone mention        3.72s -> 3.72s       lone mention      11.60s -> 11.73s
+                        with a 50 ms window                    with a 50 ms window
+
+Batching four mentions at a time lifts aggregate throughput by a third to a
+half, and the 50 ms window that lets mentions join a batch costs a lone
+mention about 1% of its reply time, so those are the defaults
+(``HELMHUD_GENERATION_BATCH_SIZE`` / ``_BATCH_WAIT_MS``). Batches of 8
+gain more, but each reply then waits on the longest in its batch and
+holds twice the key/value cache memory.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guardian import llm  # noqa: E402
+from guardian.backends import BACKENDS, create_backend  # noqa: E402
+
+QUESTIONS = [
+    "What is a StarCode?",
+    "How do I unlock the Knight's Chapel?",
+    "Who blessed the 🔥🌟 chain?",
+    "What does the vortex glyph mean?",
+    "How do remories work?",
+    "Which role comes after Memory Mason?",
+    "Can you explain divine alignment?",
+    "What happened in the lab yesterday?",
+]
+
+
+def storm_prompts(count):
+    prompts = []
+    for n in range(count):
+        prompts.append(
+            llm.PROMPT_PREAMBLE
+            + f"user{n}: hello everyone\nuser{n + 1}: 🔥🌟 just unlocked the lab\n\n"
+            "### Influential Memories:\nThe StarForge Lab opens with 💡⚡🔍\n\n"
+            f"### User Query:\n{QUESTIONS[n % len(QUESTIONS)]}\n\n### Reply:\n"
+        )
+    return prompts
+
+
+async def storm(prompts, batch_size, tokens, batch_wait=llm.GENERATION_BATCH_WAIT):
+    scheduler = llm.GenerationScheduler(
+        concurrency=1,
+        max_queued=len(prompts),
+        per_user=1,
+        batch_size=batch_size,
+        batch_wait=batch_wait,
+    )
+    started = time.perf_counter()
+    futures = [
+        scheduler.submit(prompt, user_id=n, channel_id=n % 3, max_tokens=tokens)
+        for n, prompt in enumerate(prompts)
+    ]
+    replies = await asyncio.gather(*futures)
+    return time.perf_counter() - started, replies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mentions", type=int, default=8)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--model", help="Causal LM to load instead of the bot's model")
+    parser.add_argument("--backend", choices=BACKENDS, default=llm.MODEL_BACKEND)
+    args = parser.parse_args()
+
+    if args.backend == "huggingface":
+        from guardian import hf_backend
+
+        if args.model:
+            hf_backend.MODEL_NAME = args.model
+        hf_backend.PREFIX_CACHE = False
+    llm._backend = create_backend(args.backend, llm.PROMPT_PREAMBLE)
+    prompts = storm_prompts(args.mentions)
+    # Loads the chat model (not the embedding model) and warms up kernels
+    # and the allocator before timing
+    llm.generate_reply(prompts[0], max_tokens=8)
+
+    baseline = None
+    print(f"{'batch':>5} {'wall s':>8} {'replies/min':>12} {'tok/s':>7} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        elapsed, replies = asyncio.run(storm(prompts, batch_size, args.tokens))
+        generated = sum(llm.count_tokens(reply) for reply in replies)
+        rate = generated / elapsed
+        baseline = baseline or rate
+        print(
+            f"{batch_size:>5} {elapsed:>8.1f} {60 * len(replies) / elapsed:>12.1f} "
+            f"{rate:>7.2f} {rate / baseline:>7.2f}x"
+        )
+
+    # What the batching window costs a mention that arrives alone (median of 3)
+    wait = llm.GENERATION_BATCH_WAIT
+    alone = [
+        statistics.median(
+            asyncio.run(storm(prompts[:1], max(args.batch_sizes), args.tokens, w))[0]
+            for _ in range(3)
+        )
+        for w in (0.0, wait)
+    ]
+    print(
+        f"\nlone mention: {alone[0]:.2f}s without a batching window, "
+        f"{alone[1]:.2f}s with {1000 * wait:.0f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
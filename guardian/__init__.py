@@ -1,7 +1,6 @@
-from .bot import bot
-from . import utils  # noqa: F401
-from . import events  # noqa: F401
-from . import commands  # noqa: F401
-from . import llm  # noqa: F401
+"""Helmhud Guardian Discord bot.
 
-__all__ = ["bot"]
+Importing the package loads nothing by itself: ``helmhud_guardian.py``
+imports the bot and the modules that register its events and commands, so
+``python -m guardian.model_worker`` can start without loading the bot.
+"""
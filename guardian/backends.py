@@ -0,0 +1,258 @@
+"""Model backends for Helmhud Guardian.
+
+``guardian.llm`` generates replies, embeds text and counts tokens through a
+:class:`ModelBackend`. ``HELMHUD_BACKEND`` picks which one:
+
+* ``huggingface`` (default) runs the transformers chat model and the
+  sentence-transformers embedding model (``guardian.hf_backend``).
+* ``stub`` returns deterministic replies and hash-based embeddings at a
+  simulated speed, so the scheduler, batching, caches and retrieval can be
+  load-tested without downloading any weights.
+
+With ``HELMHUD_MODEL_WORKER`` set, the bot sends the same calls to a model
+worker that runs one of these (``guardian.model_worker``).
+"""
+
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple
+
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("huggingface", "stub")
+
+# Stub backend speed and shape: generated tokens per second (per batch
+# step), milliseconds per embedded text, seconds load() takes, and tokens
+# per reply before max_tokens applies
+STUB_TOKENS_PER_SECOND = float(os.getenv("HELMHUD_STUB_TOKENS_PER_SECOND", "20"))
+STUB_EMBED_MS = float(os.getenv("HELMHUD_STUB_EMBED_MS", "0.5"))
+STUB_LOAD_SECONDS = float(os.getenv("HELMHUD_STUB_LOAD_SECONDS", "0"))
+STUB_REPLY_TOKENS = int(os.getenv("HELMHUD_STUB_REPLY_TOKENS", "40"))
+STUB_EMBEDDING_DIM = 384
+
+# Every mention prompt starts with this preamble and first section header.
+# The Hugging Face backend reuses its key/value cache so only the rest of
+# the prompt is prefilled.
+PROMPT_PREAMBLE = (
+    "You are Helmhud Guardian, a helpful Discord bot. "
+    "Respond to the user based on the conversation and memories.\n\n"
+    "### Recent Conversation:\n"
+)
+
+
+def clean_reply(text: str) -> str:
+    """Strip end markers and any echoed prompt from generated text."""
+    text = re.sub(r"<\|end.*?>", "", text)
+    # Some models still restate the reply header. If so, strip everything
+    # up to the explicit reply section.
+    if "### Reply:" in text:
+        text = text.split("### Reply:", 1)[1]
+    elif "Reply:" in text:
+        text = text.split("Reply:", 1)[1]
+    return text.strip()
+
+
+class ModelBackend(ABC):
+    """What the LLM layer needs from the models.
+
+    Methods block and are called from worker threads, so implementations
+    must be thread-safe. Any of them may load the models on first use.
+    Subclasses must implement the abstract methods to be instantiated.
+    """
+
+    name = "base"
+    # Identifies the embedding space, so cached embeddings and stored
+    # indexes made with one backend are never searched with another's
+    embedding_name = ""
+
+    def is_cached(self) -> bool:
+        """Whether load() can run without downloading anything."""
+        return True
+
+    def load(self) -> None:
+        """Load the models; a no-op once they are loaded."""
+
+    @abstractmethod
+    def generate(self, prompt: str, max_tokens: int = 300, on_text=None, should_stop=None) -> str:
+        """Return the reply to ``prompt``, passing each decoded chunk to ``on_text``.
+
+        ``should_stop``, if given, is polled while decoding; once it returns
+        True the reply generated so far is returned.
+        """
+
+    def generate_batch(
+        self, prompts: List[str], max_tokens: int = 300, on_texts=None, should_stop=None
+    ) -> List[str]:
+        """Return a reply per prompt.
+
+        ``on_texts`` and ``should_stop`` hold a callback (or ``None``) per
+        prompt, as for :meth:`generate`.
+        """
+        on_texts = list(on_texts) if on_texts is not None else [None] * len(prompts)
+        should_stop = list(should_stop) if should_stop is not None else [None] * len(prompts)
+        return [
+            self.generate(prompt, max_tokens, on_text, stop)
+            for prompt, on_text, stop in zip(prompts, on_texts, should_stop)
+        ]
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return one float32 embedding row per text."""
+
+    @abstractmethod
+    def count_tokens(self, text: str) -> int:
+        """Return the number of tokens in ``text``."""
+
+    @abstractmethod
+    def truncate_tokens(self, text: str, limit: int) -> Tuple[str, int]:
+        """Cut ``text`` to at most ``limit`` tokens; also return its full token count."""
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Sections to merge into ``!vault llm_stats``."""
+        return {}
+
+
+_STUB_WORDS = (
+    "helm", "guardian", "chain", "vault", "remory", "blessing", "signal", "harbor",
+    "watch", "lantern", "tide", "anchor", "compass", "beacon", "keel", "crew",
+)
+_STUB_TOKEN = re.compile(r"\w+")
+
+
+def _digest(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class StubBackend(ModelBackend):
+    """Deterministic stand-in for the models.
+
+    A reply is a run of words seeded by the prompt, produced one word
+    (token) per ``1 / tokens_per_second`` seconds; a batch advances all its
+    rows in each step, like batched decoding, and a row ends early once its
+    ``should_stop`` returns True. Embeddings hash each word to a signed
+    dimension, so texts sharing words are similar and identical texts are
+    identical. Tokens are whitespace-separated words.
+    """
+
+    name = "stub"
+    embedding_name = f"stub-hash-{STUB_EMBEDDING_DIM}"
+
+    def __init__(
+        self,
+        tokens_per_second: float = STUB_TOKENS_PER_SECOND,
+        embed_ms: float = STUB_EMBED_MS,
+        load_seconds: float = STUB_LOAD_SECONDS,
+        reply_tokens: int = STUB_REPLY_TOKENS,
+    ):
+        self.tokens_per_second = tokens_per_second
+        self.embed_ms = embed_ms
+        self.load_seconds = load_seconds
+        self.reply_tokens = reply_tokens
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stats: Counter = Counter()
+
+    def load(self) -> None:
+        with self._lock:
+            if not self._loaded:
+                time.sleep(self.load_seconds)
+                self._loaded = True
+
+    def _words(self, prompt: str, max_tokens: int) -> List[str]:
+        rng = random.Random(_digest(prompt))
+        return [rng.choice(_STUB_WORDS) for _ in range(min(max_tokens, self.reply_tokens))]
+
+    def _decode(self, rows: List[List[str]], on_texts, should_stop) -> None:
+        """Simulate decoding ``rows``, cutting stopped rows short in place."""
+        started = time.perf_counter()
+        for step in range(max(map(len, rows), default=0)):
+            for words, stop in zip(rows, should_stop):
+                if step < len(words) and stop is not None and stop():
+                    del words[step:]
+            if not any(step < len(words) for words in rows):
+                break
+            if self.tokens_per_second > 0:
+                time.sleep(1 / self.tokens_per_second)
+            for words, on_text in zip(rows, on_texts):
+                if on_text is not None and step < len(words):
+                    on_text(words[step] if step == len(words) - 1 else words[step] + " ")
+        with self._lock:
+            self._stats["replies"] += len(rows)
+            self._stats["tokens"] += sum(map(len, rows))
+            self._stats["seconds"] += time.perf_counter() - started
+
+    def generate(self, prompt: str, max_tokens: int = 300, on_text=None, should_stop=None) -> str:
+        return self.generate_batch([prompt], max_tokens, [on_text], [should_stop])[0]
+
+    def generate_batch(
+        self, prompts: List[str], max_tokens: int = 300, on_texts=None, should_stop=None
+    ) -> List[str]:
+        self.load()
+        on_texts = list(on_texts) if on_texts is not None else [None] * len(prompts)
+        should_stop = list(should_stop) if should_stop is not None else [None] * len(prompts)
+        rows = [self._words(prompt, max_tokens) for prompt in prompts]
+        self._decode(rows, on_texts, should_stop)
+        return [" ".join(words) for words in rows]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        self.load()
+        if self.embed_ms > 0:
+            time.sleep(self.embed_ms * len(texts) / 1000)
+        vectors = np.zeros((len(texts), STUB_EMBEDDING_DIM), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in _STUB_TOKEN.findall(text.lower()) or [text]:
+                h = _digest(token)
+                vectors[row, h % STUB_EMBEDDING_DIM] += 1 if h >> 63 else -1
+            norm = np.linalg.norm(vectors[row])
+            if norm:
+                vectors[row] /= norm
+        with self._lock:
+            self._stats["embedded_texts"] += len(texts)
+        return vectors
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def truncate_tokens(self, text: str, limit: int) -> Tuple[str, int]:
+        words = text.split()
+        if len(words) > limit:
+            text = " ".join(words[:limit])
+        return text, len(words)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            "stub_backend": {
+                "replies": stats.get("replies", 0),
+                "tokens_per_second": (
+                    stats["tokens"] / stats["seconds"] if stats.get("seconds") else 0.0
+                ),
+                "embedded_texts": stats.get("embedded_texts", 0),
+            },
+        }
+
+
+def create_backend(name: str, preamble: str = "") -> ModelBackend:
+    """Return the backend called ``name``.
+
+    ``preamble`` is the text every bot prompt starts with; backends may
+    cache work for it.
+    """
+    if name == "huggingface":
+        from .hf_backend import HuggingFaceBackend
+
+        return HuggingFaceBackend(preamble)
+    if name == "stub":
+        return StubBackend()
+    raise ValueError(f"Unknown model backend {name!r}; expected one of {', '.join(BACKENDS)}")
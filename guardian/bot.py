@@ -14,19 +14,15 @@ import io
 from typing import Optional, List, Tuple
 import logging
 
-import bleach
-from PIL import Image
-import magic
 import time
 from pathlib import Path
 
+from .config import DATA_DIR
+
 # Load environment variables
 load_dotenv()
 # Set up module logger
 logger = logging.getLogger(__name__)
-# Base directory for persistent data files (override with HELMHUD_DATA_DIR env var)
-DATA_DIR = Path(os.getenv("HELMHUD_DATA_DIR", Path(__file__).resolve().parent.parent))
-DATA_DIR.mkdir(parents=True, exist_ok=True)
 # ============ ENHANCED BOT CLASS ============
 class HelmhudGuardian(commands.Bot):
     def __init__(self, *args, **kwargs):
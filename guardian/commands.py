@@ -3,6 +3,7 @@ from discord.ext import commands, tasks
 from .bot import bot
 from .utils import *
 from .config import *
+from .llm import add_memory, rebuild_index, llm_stats
 import asyncio
 import os
 import json
@@ -330,21 +331,8 @@ async def profile(ctx, *, target: str = None):
             try:
                 member = ctx.guild.get_member(int(target))
             except ValueError:
-                # Try to find by name/nickname
-                target_lower = target.lower()
-                
-                # First try exact matches
-                for m in ctx.guild.members:
-                    if m.name.lower() == target_lower or m.display_name.lower() == target_lower:
-                        member = m
-                        break
-                
-                # If no exact match, try partial matches
-                if not member:
-                    for m in ctx.guild.members:
-                        if target_lower in m.name.lower() or target_lower in m.display_name.lower():
-                            member = m
-                            break
+                # Try to find by name/nickname (exact, then partial matches)
+                member = find_member_by_name(ctx.guild, target)
         
         if not member:
             # Try using Discord's converter as last resort
@@ -503,18 +491,7 @@ async def diagnose_user(ctx, *, target: str = None):
             try:
                 member = ctx.guild.get_member(int(target))
             except ValueError:
-                target_lower = target.lower()
-                
-                for m in ctx.guild.members:
-                    if m.name.lower() == target_lower or m.display_name.lower() == target_lower:
-                        member = m
-                        break
-                
-                if not member:
-                    for m in ctx.guild.members:
-                        if target_lower in m.name.lower() or target_lower in m.display_name.lower():
-                            member = m
-                            break
+                member = find_member_by_name(ctx.guild, target)
         
         if not member:
             try:
@@ -982,9 +959,12 @@ async def backfill_server(ctx, limit: int = None):
                             "timestamp": message.created_at,
                             "context": message.content[:100],
                             "channel": channel.name,
+                            "channel_id": channel.id,
+                            "guild_id": channel.guild.id,
                             "message_id": message.id
                         }
                         bot.user_data[message.author.id]["remory_strings"].append(remory)
+                        add_memory(remory)
                         bot.user_data[message.author.id]["starcode_chains"].append(emojis)
                         existing_remories[message.author.id].add(message.id)
                         stats["remories_stored"] += 1
@@ -3219,6 +3199,46 @@ async def vault_status(ctx):
     
     await ctx.send(embed=embed)
 
+# ============ MEMORY INDEX COMMANDS ============
+@bot.command(name='rebuild_memory')
+@commands.has_permissions(administrator=True)
+async def rebuild_memory(ctx):
+    """Admin: Re-embed every remory into a fresh LLM memory index"""
+    status_msg = await ctx.send("🧠 Rebuilding memory index...")
+    start_time = datetime.now()
+    try:
+        count = await rebuild_index()
+    except Exception as e:
+        logger.error(f"Memory index rebuild failed: {e}")
+        await safe_edit_message(status_msg, content=f"❌ Memory index rebuild failed: {e}")
+        return
+    elapsed = (datetime.now() - start_time).total_seconds()
+    await safe_edit_message(
+        status_msg,
+        content=f"✅ Memory index rebuilt with **{count}** remories in {elapsed:.1f}s"
+    )
+
+@bot.command(name='llm_stats')
+@commands.has_permissions(administrator=True)
+async def show_llm_stats(ctx):
+    """Admin: Show LLM, memory index and cache statistics"""
+    embed = discord.Embed(
+        title="🧠 Guardian Mind Statistics",
+        color=0x9370DB
+    )
+    for section, values in llm_stats().items():
+        lines = []
+        for name, value in values.items():
+            if isinstance(value, float):
+                value = f"{value:.1%}" if name.endswith("rate") else f"{value:.3f}"
+            lines.append(f"{name.replace('_', ' ').title()}: **{value}**")
+        embed.add_field(
+            name=section.replace("_", " ").title(),
+            value="\n".join(lines) or "No data",
+            inline=False
+        )
+    await ctx.send(embed=embed)
+
 # ============ CLEANUP TASKS ============
 @tasks.loop(minutes=10)
 async def cleanup_shield_listeners():
@@ -3241,10 +3261,8 @@ import re
 from datetime import datetime, timedelta
 from typing import Optional, List, Tuple
 
-# Security libraries
-import bleach
-from PIL import Image, ImageChops
-import magic  # python-magic for file type detection
+# Security libraries (bleach, Pillow) are imported where they are used so
+# they don't slow down bot startup
 
 # ============ SECURITY CONFIGURATION ============
 class ReportSecurityConfig:
@@ -3289,6 +3307,8 @@ def sanitize_report_text(text: str, max_length: int = ReportSecurityConfig.MAX_M
     """Sanitize text using bleach and Discord-specific rules"""
     if not text:
         return "No text provided"
+
+    import bleach
     
     # First, handle potential Unicode escape sequences by encoding/decoding
     try:
@@ -3353,6 +3373,8 @@ async def validate_image_file(attachment: discord.Attachment) -> Tuple[bool, Opt
     Securely validate an image file using Pillow
     Returns: (is_valid, file_data_if_valid, error_message)
     """
+    from PIL import Image
+
     try:
         # Check file extension
         file_ext = os.path.splitext(attachment.filename.lower())[1]
@@ -3508,6 +3530,8 @@ async def validate_image_file(attachment: discord.Attachment) -> Tuple[bool, Opt
 
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename using bleach and additional rules"""
+    import bleach
+
     # Get base name and extension
     base, ext = os.path.splitext(filename)
     
@@ -4312,6 +4336,8 @@ async def check_role_progression(member, guild, channel=None):
 @bot.event
 async def on_member_join(member):
     """When a member joins, check if they should have any roles"""
+    index_member(member)
+
     if member.bot:
         return
     
@@ -1,3 +1,14 @@
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Base directory for persistent data files (override with HELMHUD_DATA_DIR env var)
+DATA_DIR = Path(os.getenv("HELMHUD_DATA_DIR", Path(__file__).resolve().parent.parent))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+
 # ============ CONFIGURATION ============
 LIBRARIAN_GLYPHS = {
     "📚": {"name": "Book", "type": "lux", "meaning": "Codex, record, memory container"},
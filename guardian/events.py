@@ -5,8 +5,9 @@ from .utils import *
 from .config import *
 from .commands import cleanup_shield_listeners, cleanup_report_cooldowns
 import asyncio
+import os
 import re
-from .llm import ensure_model_downloaded
+from .llm import start_model_warmup, save_memory_index, consolidate_memories, attribute_remory_guilds
 
 # ============ EVENT HANDLERS ============
 @bot.event
@@ -14,7 +15,8 @@ async def on_ready():
     print(f'✠ {bot.user} has connected to the Vault')
     print(f'✠ Serving {len(bot.guilds)} guild(s)')
     print(f'✠ The semantic field awaits...')
-    ensure_model_downloaded()
+    start_model_warmup()
+    attribute_remory_guilds()
 
     # Start tasks only if they're not already running
     if not cleanup_shield_listeners.is_running():
@@ -25,6 +27,53 @@ async def on_ready():
         auto_register_reaction_chains.start()
     if not cleanup_report_cooldowns.is_running():
         cleanup_report_cooldowns.start()
+    if not save_memory_index.is_running():
+        save_memory_index.start()
+    if not consolidate_memories.is_running():
+        consolidate_memories.start()
+
+@bot.event
+async def on_member_update(before, after):
+    """Keep the member name index current when nicknames change"""
+    if before.display_name != after.display_name:
+        index_member(after)
+
+@bot.event
+async def on_user_update(before, after):
+    """Keep the member name index current when usernames change"""
+    if before.name == after.name and before.display_name == after.display_name:
+        return
+    for guild in after.mutual_guilds:
+        member = guild.get_member(after.id)
+        if member:
+            index_member(member)
+
+@bot.event
+async def on_member_remove(member):
+    unindex_member(member)
+
+# Raw events also fire for messages outside discord.py's message cache,
+# such as those primed from channel history
+@bot.event
+async def on_raw_message_edit(payload):
+    content = payload.data.get("content")
+    if content is not None:
+        recent_messages.edit(payload.channel_id, payload.message_id, content)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    recent_messages.delete(payload.channel_id, payload.message_id)
+    task = answering_mentions.pop(payload.message_id, None)
+    if task is not None:
+        task.cancel()
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    for message_id in payload.message_ids:
+        recent_messages.delete(payload.channel_id, message_id)
+        task = answering_mentions.pop(message_id, None)
+        if task is not None:
+            task.cancel()
 
 @bot.event
 async def on_reaction_add(reaction, user):
@@ -52,6 +101,13 @@ async def on_reaction_add(reaction, user):
             # Unregister if already registered
             if chain_key in bot.starcode_patterns:
                 await unregister_chain(chain_key, "problematic", user.id)
+
+            # Keep the flagged message out of LLM memory retrieval
+            from .llm import forget_memories
+            forget_memories(
+                r for r in bot.user_data[message.author.id]["remory_strings"]
+                if r.get("message_id") == message.id
+            )
             
             # Add to problematic registry
             bot.problematic_chains.append({
@@ -137,10 +193,82 @@ async def on_reaction_add(reaction, user):
     # Check role progression and announce in the configured progression channel
     await check_role_progression(user, reaction.message.guild)
 
+# Streamed replies edit their placeholder at most this often (seconds);
+# Discord allows roughly five edits per five seconds per channel
+REPLY_EDIT_INTERVAL = float(os.getenv("HELMHUD_REPLY_EDIT_INTERVAL", "1.5"))
+STREAM_REPLIES = os.getenv("HELMHUD_STREAM_REPLIES", "1").lower() not in ("0", "false", "no")
+SENTENCE_END = re.compile(r"[.!?…](?:\s|$)|\n")
+REPLY_TIMEOUT_MESSAGE = "⌛ That took me too long to think through. Please ask again!"
+WARMING_UP_MESSAGE = "🌅 I'm still warming up my thoughts. Please ask again in a minute!"
+MODEL_FAILED_MESSAGE = (
+    "⚠️ I couldn't load my language model, so I can't answer yet. "
+    "I'll keep trying; if this lasts, please let an admin know."
+)
+
+# Tasks answering mentions, by message ID, so deleting a mention can cancel
+# its reply
+answering_mentions = {}
+
+def clean_bot_reply(text):
+    """Remove any bot mentions the model produced"""
+    text = re.sub(rf"<@!?{bot.user.id}>", "", text)
+    text = text.replace(f"@{bot.user.display_name}", "")
+    text = text.replace(f"@{bot.user.name}", "")
+    return text.strip()
+
+class ReplyStream:
+    """Show a streaming reply by editing a placeholder message.
+
+    Text is revealed a whole sentence at a time and edits are spaced
+    ``REPLY_EDIT_INTERVAL`` apart to stay clear of rate limits.
+    """
+
+    def __init__(self, placeholder, prefix):
+        self.placeholder = placeholder
+        self.prefix = prefix
+        self.text = ""
+        self.shown = ""
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def feed(self, chunk):
+        self.text += chunk
+        self.changed.set()
+
+    def visible(self):
+        from .backends import clean_reply
+        ends = [m.end() for m in SENTENCE_END.finditer(self.text)]
+        return clean_bot_reply(clean_reply(self.text[:ends[-1]])) if ends else ""
+
+    async def run(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            visible = self.visible()
+            if visible and visible != self.shown:
+                await safe_edit_message(self.placeholder, content=f"{self.prefix} {visible} ✍️"[:2000])
+                self.shown = visible
+                await asyncio.sleep(REPLY_EDIT_INTERVAL)
+
+    async def finish(self, content):
+        """Stop streaming and show the final ``content``."""
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, discord.HTTPException):
+            pass
+        try:
+            await safe_edit_message(self.placeholder, content=content[:2000])
+        except discord.NotFound:
+            # Placeholder was deleted meanwhile; post the reply fresh
+            await safe_send(self.placeholder.channel, content[:2000])
+
 @bot.event
 async def on_message(message):
     if message.author.bot:
         return
+
+    recent_messages.add(message)
     
     emoji_sequences = find_contiguous_emoji_chains(message.content)
     for emojis in emoji_sequences:
@@ -165,11 +293,13 @@ async def on_message(message):
             "timestamp": datetime.now(),
             "context": remory_text[:100],
             "channel": message.channel.name,
+            "channel_id": message.channel.id,
+            "guild_id": message.guild.id if message.guild else None,
             "message_id": message.id
         }
         bot.user_data[message.author.id]["remory_strings"].append(remory)
-        from .llm import invalidate_index
-        invalidate_index()
+        from .llm import add_memory
+        add_memory(remory)
 
         unlock_message = await check_starlock(emojis, message.author, message.guild)
         if unlock_message:
@@ -186,57 +316,162 @@ async def on_message(message):
                 "timestamp": datetime.now(),
                 "context": remory_text[:100],
                 "channel": message.channel.name,
+                "channel_id": message.channel.id,
+                "guild_id": message.guild.id if message.guild else None,
                 "message_id": message.id,
             }
             bot.user_data[message.author.id]["remory_strings"].append(remory)
-            from .llm import invalidate_index
-            invalidate_index()
+            from .llm import add_memory
+            add_memory(remory)
 
     # LLM chat when the bot is mentioned
     if bot.user in message.mentions:
-        query = strip_bot_mentions(message.content)
-
-        # Gather recent context excluding the bot's own messages
-        recent_lines = []
-        async for msg in message.channel.history(limit=5, before=message):
-            if msg.author.bot:
-                continue
-            clean_text = strip_all_mentions(msg.clean_content)
-            recent_lines.append(f"{msg.author.display_name}: {clean_text}")
-        recent_lines.reverse()
-        recent_context = "\n".join(recent_lines)
-
-        from .llm import get_similar, generate_reply
-        memories = get_similar(query, k=5)
-        unique_memories = []
-        seen = set()
-        for mem in memories:
-            if mem not in seen:
-                unique_memories.append(mem)
-                seen.add(mem)
-        memory_block = "\n".join(strip_all_mentions(mem) for mem in unique_memories)
-
-        prompt = (
-            "You are Helmhud Guardian, a helpful Discord bot. "
-            "Respond to the user based on the conversation and memories.\n\n"
-            "### Recent Conversation:\n" + recent_context +
-            "\n\n### Influential Memories:\n" + memory_block +
-            "\n\n### User Query:\n" + query +
-            "\n\n### Reply:\n"
-        )
-        reply = await asyncio.to_thread(generate_reply, prompt)
-        # Remove any bot mentions the model produced
-        reply = re.sub(rf"<@!?{bot.user.id}>", "", reply)
-        reply = reply.replace(f"@{bot.user.display_name}", "")
-        reply = reply.replace(f"@{bot.user.name}", "")
-        reply = reply.strip()
-
-        # Prepend the author's mention and avoid double mention
-        reply = f"{message.author.mention} {reply}".strip()
-        await message.reply(reply, mention_author=False)
+        # Deleting the mention cancels its reply, generation included
+        answering_mentions[message.id] = asyncio.current_task()
+        try:
+            await answer_mention(message)
+        finally:
+            answering_mentions.pop(message.id, None)
         return
     await bot.process_commands(message)
 
+async def answer_mention(message):
+    """Reply to a message mentioning the bot using the LLM."""
+    from .llm import model_ready, model_warmup_error
+    if not model_ready():
+        await message.reply(
+            MODEL_FAILED_MESSAGE if model_warmup_error() else WARMING_UP_MESSAGE,
+            mention_author=False,
+        )
+        return
+    query = strip_bot_mentions(message.content)
+    guild_id = message.guild.id if message.guild else None
+
+    # Frequently asked questions are answered from the response cache
+    from .llm import lookup_cached_reply, remember_reply
+    cached, query_embedding = await lookup_cached_reply(query, guild_id)
+    if cached is not None:
+        await message.reply(f"{message.author.mention} {cached}".strip(), mention_author=False)
+        return
+
+    # Gather recent context excluding the bot's own messages. The buffer
+    # is fed by on_message; history is only fetched on a cold start.
+    recent_lines = recent_messages.lines(message.channel.id, message.id, limit=5)
+    if recent_lines is None:
+        history = [
+            msg async for msg in message.channel.history(limit=5, before=message)
+            if not msg.author.bot
+        ]
+        recent_messages.prime(message.channel.id, history)
+        recent_lines = recent_messages.lines(message.channel.id, message.id, limit=5)
+
+    from .llm import (
+        GenerationMerged,
+        GenerationQueueFull,
+        GenerationTimeout,
+        build_prompt,
+        generate_reply_async,
+        get_similar_async,
+    )
+    memories = await get_similar_async(
+        query,
+        k=5,
+        guild_id=guild_id,
+        channel_id=message.channel.id,
+        query_embedding=query_embedding,
+    )
+    # Token counting may load the tokenizer or call the model worker
+    prompt = await asyncio.to_thread(
+        build_prompt,
+        recent_lines,
+        [strip_all_mentions(mem) for mem in memories],
+        query,
+    )
+    if STREAM_REPLIES:
+        reply = await stream_llm_reply(message, prompt)
+        remember_reply(guild_id, query_embedding, reply, memories)
+        return
+
+    try:
+        reply = await generate_reply_async(
+            prompt, user_id=message.author.id, channel_id=message.channel.id
+        )
+    except GenerationQueueFull:
+        await message.reply(
+            "⏳ I'm answering a lot of questions right now. Please ask again in a moment!",
+            mention_author=False,
+        )
+        return
+    except GenerationMerged:
+        # A newer mention from the same user is answered instead
+        return
+    except GenerationTimeout as e:
+        # Post what was generated in time, but don't cache a cut-off reply
+        partial = clean_bot_reply(e.reply)
+        await message.reply(
+            f"{message.author.mention} {partial} …" if partial else REPLY_TIMEOUT_MESSAGE,
+            mention_author=False,
+        )
+        return
+    reply = clean_bot_reply(reply)
+    remember_reply(guild_id, query_embedding, reply, memories)
+
+    # Prepend the author's mention and avoid double mention
+    reply = f"{message.author.mention} {reply}".strip()
+    await message.reply(reply, mention_author=False)
+
+async def stream_llm_reply(message, prompt):
+    """Answer a mention with a placeholder reply that fills in as the LLM streams.
+
+    Returns the reply text, or ``None`` if there wasn't one.
+    """
+    from .llm import GenerationMerged, GenerationQueueFull, GenerationTimeout, generate_reply_async
+
+    placeholder = await message.reply(f"{message.author.mention} 💭 *thinking...*", mention_author=False)
+    stream = ReplyStream(placeholder, message.author.mention)
+    try:
+        reply = await generate_reply_async(
+            prompt,
+            user_id=message.author.id,
+            channel_id=message.channel.id,
+            on_text=stream.feed,
+        )
+    except GenerationQueueFull:
+        await stream.finish(
+            f"{message.author.mention} ⏳ I'm answering a lot of questions right now. "
+            "Please ask again in a moment!"
+        )
+        return None
+    except GenerationMerged:
+        # A newer mention from the same user is answered instead
+        stream.task.cancel()
+        try:
+            await placeholder.delete()
+        except discord.HTTPException:
+            pass
+        return None
+    except GenerationTimeout as e:
+        partial = clean_bot_reply(e.reply)
+        await stream.finish(
+            f"{message.author.mention} {partial} …" if partial
+            else f"{message.author.mention} {REPLY_TIMEOUT_MESSAGE}"
+        )
+        return None
+    except asyncio.CancelledError:
+        # The mention was deleted or the bot is shutting down
+        stream.task.cancel()
+        try:
+            await placeholder.delete()
+        except discord.HTTPException:
+            pass
+        raise
+    except Exception:
+        await stream.finish(f"{message.author.mention} ⚠️ I couldn't finish that thought. Please try again.")
+        raise
+    reply = clean_bot_reply(reply)
+    await stream.finish(f"{message.author.mention} {reply}".strip())
+    return reply
+
 async def complete_training_quest(user, channel):
     """Complete a training quest and progress to next"""
     user_data = bot.user_data[user.id]
@@ -0,0 +1,570 @@
+"""Hugging Face model backend for Helmhud Guardian.
+
+Runs the chat model with ``transformers`` and embeds with
+``sentence-transformers``. This is the default backend; ``guardian.llm``
+reaches it through :class:`HuggingFaceBackend`. torch, transformers and
+sentence-transformers take seconds to import, so they are imported when
+the models are first loaded rather than with this module.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import copy
+import functools
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from .backends import ModelBackend, clean_reply
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "mrfakename/Apriel-5B-Instruct-llamafied"
+EMB_MODEL_NAME = "all-MiniLM-L6-v2"
+
+_tokenizer = None
+# Left-padding copy of the tokenizer for batches, so the shared one never
+# has padding switched on under a concurrent count or truncation
+_batch_tokenizer = None
+_model = None
+_emb_model = None
+# Draft model for assisted generation; False once found unusable
+_draft_model = None
+
+# Opt-in CPU inference. "int8" loads float32 weights and dynamically
+# quantizes every Linear layer to int8; "bf16" loads bfloat16 weights when
+# the CPU supports them (float32 otherwise). Thread counts of 0 leave
+# torch's defaults. Compare modes with benchmarks/cpu_inference.py.
+CPU_MODES = ("int8", "bf16")
+CPU_MODE = os.getenv("HELMHUD_CPU_MODE", "").lower()
+TORCH_THREADS = int(os.getenv("HELMHUD_TORCH_THREADS", "0"))
+TORCH_INTEROP_THREADS = int(os.getenv("HELMHUD_TORCH_INTEROP_THREADS", "0"))
+
+# Optional small draft model for assisted generation. It must share the
+# chat model's vocabulary; otherwise replies decode normally.
+DRAFT_MODEL = os.getenv("HELMHUD_DRAFT_MODEL", "")
+
+# The key/value cache of the bot's prompt preamble is computed once and
+# reused so only the rest of each prompt is prefilled; HELMHUD_PREFIX_CACHE=0
+# disables that.
+PREFIX_CACHE = os.getenv("HELMHUD_PREFIX_CACHE", "1").lower() not in ("0", "false", "no")
+
+
+# Serializes model loading between the warm-up task and the worker threads
+_load_lock = threading.RLock()
+_batch_encode_lock = threading.Lock()
+
+
+def _load_emb_model():
+    global _emb_model
+    with _load_lock:
+        if _emb_model is None:
+            from sentence_transformers import SentenceTransformer
+
+            logger.info("Loading embedding model %s", EMB_MODEL_NAME)
+            started = time.perf_counter()
+            _emb_model = SentenceTransformer(EMB_MODEL_NAME)
+            logger.info("Embedding model loaded in %.1fs", time.perf_counter() - started)
+
+
+def _load_tokenizer():
+    global _tokenizer
+    with _load_lock:
+        if _tokenizer is None:
+            from transformers import AutoTokenizer
+
+            logger.info("Loading tokenizer %s", MODEL_NAME)
+            started = time.perf_counter()
+            _tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+            logger.info("Tokenizer loaded in %.1fs", time.perf_counter() - started)
+
+
+def _load_batch_tokenizer():
+    global _batch_tokenizer
+    with _load_lock:
+        if _batch_tokenizer is None:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, padding_side="left")
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            _batch_tokenizer = tokenizer
+
+
+def bf16_supported() -> bool:
+    """Whether this CPU has native bfloat16 kernels."""
+    import torch
+
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def configure_torch_threads() -> None:
+    import torch
+
+    if TORCH_THREADS:
+        torch.set_num_threads(TORCH_THREADS)
+    if TORCH_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError:
+            # Only settable before the first inter-op parallel work
+            logger.warning("Torch inter-op thread count was already fixed; ignoring")
+
+
+def load_causal_lm(mode: str = CPU_MODE, name: Optional[str] = None):
+    """Load a causal LM (the chat model by default) for ``mode``.
+
+    ``mode`` "" keeps the default device placement.
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    name = name or MODEL_NAME
+    if mode and mode not in CPU_MODES:
+        logger.warning("Unknown HELMHUD_CPU_MODE %r; using the default mode", mode)
+        mode = ""
+    if not mode:
+        return AutoModelForCausalLM.from_pretrained(
+            name, device_map="auto", torch_dtype="auto"
+        )
+    configure_torch_threads()
+    dtype = torch.float32
+    if mode == "bf16":
+        if bf16_supported():
+            dtype = torch.bfloat16
+        else:
+            logger.warning("CPU lacks bfloat16 support; loading float32 weights")
+    model = AutoModelForCausalLM.from_pretrained(
+        name, device_map="cpu", torch_dtype=dtype, low_cpu_mem_usage=True
+    )
+    if mode == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    logger.info(
+        "Loaded %s for CPU (%s, %d threads)", name, mode, torch.get_num_threads()
+    )
+    return model.eval()
+
+
+# Forward passes per model in the current thread's generation, used to
+# estimate how many drafted tokens the chat model accepted
+_forward_counts = threading.local()
+
+
+def _count_forwards(name: str):
+    def hook(module, args, output):
+        setattr(_forward_counts, name, getattr(_forward_counts, name, 0) + 1)
+    return hook
+
+
+def _load_draft_model() -> None:
+    """Load HELMHUD_DRAFT_MODEL if set and its vocabulary matches the chat model's."""
+    global _draft_model
+    with _load_lock:
+        if _draft_model is not None or not DRAFT_MODEL:
+            return
+        from transformers import AutoTokenizer
+
+        try:
+            draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL)
+            if draft_tokenizer.get_vocab() != _tokenizer.get_vocab():
+                logger.warning(
+                    "Draft model %s doesn't share %s's vocabulary; decoding normally",
+                    DRAFT_MODEL, MODEL_NAME,
+                )
+                _draft_model = False
+                return
+            started = time.perf_counter()
+            _draft_model = load_causal_lm(name=DRAFT_MODEL)
+        except OSError as e:
+            logger.warning("Could not load draft model %s; decoding normally: %s", DRAFT_MODEL, e)
+            _draft_model = False
+            return
+        _draft_model.register_forward_hook(_count_forwards("draft"))
+        _model.register_forward_hook(_count_forwards("target"))
+        logger.info("Draft model loaded in %.1fs", time.perf_counter() - started)
+
+
+def _load_models(embedding: bool = True):
+    """Load the chat (and draft) model, and unless ``embedding`` is False the embedding model."""
+    global _model
+    try:
+        _load_tokenizer()
+        with _load_lock:
+            if _model is None:
+                logger.info("Loading model %s", MODEL_NAME)
+                started = time.perf_counter()
+                _model = load_causal_lm()
+                logger.info("Chat model loaded in %.1fs", time.perf_counter() - started)
+        _load_draft_model()
+        if embedding:
+            _load_emb_model()
+    except OSError as e:
+        raise RuntimeError(
+            f"Failed to download model files for {MODEL_NAME}. "
+            "Ensure you have internet access and, if the model is gated, run "
+            "`huggingface-cli login` before starting the bot."
+        ) from e
+
+
+def models_cached() -> bool:
+    """Whether the chat and embedding models are in the local Hugging Face cache.
+
+    Only looks for their config files, so nothing is loaded or downloaded.
+    """
+    from huggingface_hub import try_to_load_from_cache
+
+    emb_repo = EMB_MODEL_NAME if "/" in EMB_MODEL_NAME else f"sentence-transformers/{EMB_MODEL_NAME}"
+    return all(
+        isinstance(try_to_load_from_cache(repo, name), str)
+        for repo, name in (
+            (MODEL_NAME, "config.json"),
+            (MODEL_NAME, "tokenizer_config.json"),
+            (emb_repo, "config.json"),
+        )
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _callback_streamer():
+    """Return the streamer class, defined on first use since it needs transformers."""
+    from transformers import TextStreamer
+
+    class CallbackStreamer(TextStreamer):
+        """Decode only newly generated tokens and hand each finished chunk to a callback."""
+
+        def __init__(self, tokenizer, on_text):
+            super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            self.on_text = on_text
+
+        def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+            if text:
+                self.on_text(text)
+
+    return CallbackStreamer
+
+
+@functools.lru_cache(maxsize=None)
+def _stop_criteria():
+    """Return the stopping-criteria class, defined on first use since it needs transformers."""
+    import torch
+    from transformers import StoppingCriteria
+
+    class CallbackCriteria(StoppingCriteria):
+        """Finish each row of a generation once its ``should_stop`` returns True."""
+
+        def __init__(self, should_stop):
+            self.should_stop = should_stop
+
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.tensor(
+                [bool(stop is not None and stop()) for stop in self.should_stop],
+                dtype=torch.bool,
+                device=input_ids.device,
+            )
+
+    return CallbackCriteria
+
+
+def _stopping(should_stop):
+    """``stopping_criteria`` for generate(), or ``None`` if no row can stop early."""
+    if not should_stop or not any(should_stop):
+        return None
+    from transformers import StoppingCriteriaList
+
+    return StoppingCriteriaList([_stop_criteria()(should_stop)])
+
+
+_prefix_lock = threading.Lock()
+# (preamble input IDs, key/value cache) once built, False if unsupported
+_prefix_cache = None
+_prefix_stats: Counter = Counter()
+# Tokens and seconds per decoding mode, plus drafted and accepted tokens
+_decode_stats: Counter = Counter()
+
+
+def _preamble_cache(preamble: str):
+    """Return ``preamble``'s input IDs and key/value cache, building them once.
+
+    Returns ``None`` when the model or transformers version can't reuse a
+    cache, in which case prompts are prefilled in full.
+    """
+    global _prefix_cache
+    with _prefix_lock:
+        if _prefix_cache is None:
+            try:
+                import torch
+                from transformers import DynamicCache
+
+                ids = _tokenizer(preamble, return_tensors="pt")["input_ids"].to(_model.device)
+                cache = DynamicCache()
+                started = time.perf_counter()
+                with torch.no_grad():
+                    _model(input_ids=ids, past_key_values=cache, use_cache=True)
+                _prefix_stats["prefill_seconds"] = time.perf_counter() - started
+                _prefix_stats["prefix_tokens"] = ids.shape[1]
+                _prefix_cache = (ids, cache)
+                logger.info(
+                    "Cached prompt preamble: %d tokens, %.3fs prefill",
+                    ids.shape[1], _prefix_stats["prefill_seconds"],
+                )
+            except Exception as e:
+                logger.info("Prompt prefix caching unavailable, prefilling in full: %s", e)
+                _prefix_cache = False
+        return _prefix_cache or None
+
+
+def _prefix_past(input_ids, preamble: str):
+    """Return a private copy of the preamble cache if ``input_ids`` start with it."""
+    import torch
+
+    cached = _preamble_cache(preamble)
+    if cached is None:
+        return None
+    ids, cache = cached
+    n = ids.shape[1]
+    # Tokenization at the preamble boundary must match what was cached
+    if input_ids.shape[1] <= n or not torch.equal(input_ids[0, :n], ids[0]):
+        return None
+    # generate() extends the cache in place
+    return copy.deepcopy(cache)
+
+
+def generate_reply(
+    prompt: str, max_tokens: int = 300, on_text=None, preamble: str = "", should_stop=None
+) -> str:
+    """Generate a reply from the LLM for a given prompt.
+
+    Only the newly generated tokens are decoded. When ``on_text`` is given
+    it is called from the generating thread with each decoded chunk as
+    soon as it is stable; decoding ends early once ``should_stop``
+    returns True. With a draft model loaded, decoding is assisted by it;
+    otherwise prompts starting with ``preamble`` reuse its cached
+    key/values.
+    """
+    global _prefix_cache
+    _load_models(embedding=False)
+
+    inputs = _tokenizer(prompt, return_tensors="pt").to(_model.device)
+    # Some models (e.g. LLaMA) don't accept token_type_ids. Ensure we never pass
+    # them to `generate` even if the tokenizer returned them.
+    gen_inputs = {k: v for k, v in inputs.items() if k != "token_type_ids"}
+    streamer = _callback_streamer()(_tokenizer, on_text) if on_text is not None else None
+    stopping = _stopping([should_stop])
+    started = time.perf_counter()
+    if _draft_model:
+        output = _assisted_generate(gen_inputs, max_tokens, streamer, stopping)
+        if output is not None:
+            return _finish_reply(output, inputs, "assisted", started)
+    past = None
+    if PREFIX_CACHE and preamble and prompt.startswith(preamble):
+        past = _prefix_past(gen_inputs["input_ids"], preamble)
+    if past is not None:
+        try:
+            output = _model.generate(
+                **gen_inputs,
+                max_new_tokens=max_tokens,
+                streamer=streamer,
+                stopping_criteria=stopping,
+                past_key_values=past,
+            )
+            _prefix_stats["hits"] += 1
+        except Exception:
+            logger.warning("Generation with the cached preamble failed; disabling it", exc_info=True)
+            with _prefix_lock:
+                _prefix_cache = False
+            past = None
+    if past is None:
+        _prefix_stats["misses"] += 1
+        output = _model.generate(
+            **gen_inputs, max_new_tokens=max_tokens, streamer=streamer, stopping_criteria=stopping
+        )
+    return _finish_reply(output, inputs, "plain", started)
+
+
+def _assisted_generate(gen_inputs, max_tokens: int, streamer, stopping):
+    """Decode with the draft model proposing tokens, or ``None`` if that fails.
+
+    The cached preamble isn't combined with a draft model; both models
+    prefill the whole prompt.
+    """
+    global _draft_model
+    _forward_counts.target = _forward_counts.draft = 0
+    try:
+        output = _model.generate(
+            **gen_inputs,
+            max_new_tokens=max_tokens,
+            streamer=streamer,
+            stopping_criteria=stopping,
+            assistant_model=_draft_model,
+        )
+    except Exception:
+        logger.warning("Assisted generation failed; decoding normally from now on", exc_info=True)
+        _draft_model = False
+        return None
+    generated = output.shape[1] - gen_inputs["input_ids"].shape[1]
+    # Each draft forward proposes one token; each chat-model forward
+    # verifies a proposal and adds one token of its own
+    _decode_stats["drafted"] += _forward_counts.draft
+    _decode_stats["accepted"] += max(0, generated - _forward_counts.target)
+    _decode_stats["assisted_replies"] += 1
+    return output
+
+
+def _finish_reply(output, inputs, mode: str, started: float) -> str:
+    new_tokens = output[0][inputs["input_ids"].shape[1]:]
+    _decode_stats[f"{mode}_tokens"] += len(new_tokens)
+    _decode_stats[f"{mode}_seconds"] += time.perf_counter() - started
+    return clean_reply(_tokenizer.decode(new_tokens, skip_special_tokens=True))
+
+
+class _BatchStreamer:
+    """Decode each row of a batched generation and pass new text to its callback.
+
+    Like ``TextStreamer``, a row's trailing partial word is held back until
+    it is complete. ``callbacks`` may contain ``None`` for rows nobody is
+    streaming.
+    """
+
+    def __init__(self, tokenizer, callbacks):
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.tokens = [[] for _ in callbacks]
+        self.sent = [0] * len(callbacks)
+        self.prompt_seen = False
+
+    def put(self, value) -> None:
+        # generate() first passes the prompt
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for row, tokens in enumerate(value.reshape(len(self.callbacks), -1).tolist()):
+            self.tokens[row].extend(tokens)
+            self._emit(row, final=False)
+
+    def end(self) -> None:
+        for row in range(len(self.callbacks)):
+            self._emit(row, final=True)
+
+    def _emit(self, row: int, final: bool) -> None:
+        callback = self.callbacks[row]
+        if callback is None:
+            return
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        end = len(text) if final else max(text.rfind(" "), text.rfind("\n")) + 1
+        if end > self.sent[row]:
+            callback(text[self.sent[row]:end])
+            self.sent[row] = end
+
+
+def generate_batch(
+    prompts: List[str], max_tokens: int = 300, on_texts=None, preamble: str = "", should_stop=None
+) -> List[str]:
+    """Generate replies for several prompts in one left-padded batch.
+
+    ``on_texts`` and ``should_stop`` optionally hold a streaming callback
+    and a stop check (or ``None``) per prompt, called from the generating
+    thread; a stopped row keeps what it has generated while the others
+    continue. A single prompt goes through :func:`generate_reply` so it
+    keeps the cached preamble.
+    """
+    on_texts = list(on_texts) if on_texts is not None else [None] * len(prompts)
+    should_stop = list(should_stop) if should_stop is not None else [None] * len(prompts)
+    if len(prompts) == 1:
+        return [generate_reply(prompts[0], max_tokens, on_texts[0], preamble, should_stop[0])]
+    _load_models(embedding=False)
+    _load_batch_tokenizer()
+
+    # Only the first padded call changes the Rust tokenizer's padding
+    # state; the lock keeps that change from overlapping another encode
+    with _batch_encode_lock:
+        inputs = _batch_tokenizer(prompts, return_tensors="pt", padding=True).to(_model.device)
+    gen_inputs = {k: v for k, v in inputs.items() if k != "token_type_ids"}
+    streamer = _BatchStreamer(_batch_tokenizer, on_texts) if any(on_texts) else None
+    output = _model.generate(
+        **gen_inputs,
+        max_new_tokens=max_tokens,
+        streamer=streamer,
+        stopping_criteria=_stopping(should_stop),
+        pad_token_id=_batch_tokenizer.pad_token_id,
+    )
+    width = inputs["input_ids"].shape[1]
+    return [clean_reply(_batch_tokenizer.decode(row[width:], skip_special_tokens=True)) for row in output]
+
+
+def _model_stats() -> Dict[str, Dict[str, float]]:
+    return {
+        "prefix_cache": {
+            "prefix_tokens": _prefix_stats["prefix_tokens"],
+            "hits": _prefix_stats["hits"],
+            "misses": _prefix_stats["misses"],
+            "prefill_seconds_saved": _prefix_stats["hits"] * _prefix_stats["prefill_seconds"],
+        },
+        "decoding": {
+            "draft_model": DRAFT_MODEL if _draft_model else "off",
+            "assisted_replies": _decode_stats["assisted_replies"],
+            "acceptance_rate": (
+                _decode_stats["accepted"] / _decode_stats["drafted"]
+                if _decode_stats["drafted"] else 0.0
+            ),
+            "assisted_tokens_per_second": (
+                _decode_stats["assisted_tokens"] / _decode_stats["assisted_seconds"]
+                if _decode_stats["assisted_seconds"] else 0.0
+            ),
+            "plain_tokens_per_second": (
+                _decode_stats["plain_tokens"] / _decode_stats["plain_seconds"]
+                if _decode_stats["plain_seconds"] else 0.0
+            ),
+        },
+    }
+
+
+class HuggingFaceBackend(ModelBackend):
+    """The chat model and embedding model, loaded in this process.
+
+    Prompts starting with ``preamble`` reuse its cached key/values.
+    """
+
+    name = "huggingface"
+    embedding_name = EMB_MODEL_NAME
+
+    def __init__(self, preamble: str = ""):
+        self.preamble = preamble
+
+    def is_cached(self) -> bool:
+        return models_cached()
+
+    def load(self) -> None:
+        _load_models()
+
+    def generate(self, prompt: str, max_tokens: int = 300, on_text=None, should_stop=None) -> str:
+        return generate_reply(prompt, max_tokens, on_text, self.preamble, should_stop)
+
+    def generate_batch(
+        self, prompts: List[str], max_tokens: int = 300, on_texts=None, should_stop=None
+    ) -> List[str]:
+        return generate_batch(prompts, max_tokens, on_texts, self.preamble, should_stop)
+
+    def embed(self, texts: List[str]):
+        _load_emb_model()
+        return _emb_model.encode(texts, convert_to_numpy=True)
+
+    def count_tokens(self, text: str) -> int:
+        _load_tokenizer()
+        return len(_tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def truncate_tokens(self, text: str, limit: int) -> Tuple[str, int]:
+        _load_tokenizer()
+        ids = _tokenizer(text, add_special_tokens=False)["input_ids"]
+        if len(ids) > limit:
+            text = _tokenizer.decode(ids[:limit], skip_special_tokens=True)
+        return text, len(ids)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return _model_stats()
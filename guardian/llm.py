@@ -1,125 +1,2360 @@
-"""Lightweight LLM interface for Helmhud Guardian."""
+"""Lightweight LLM interface for Helmhud Guardian.
 
-from typing import List
+FAISS and the model libraries are imported on first use, so importing the
+bot doesn't pay for them before it connects (see benchmarks/import_time.py).
+"""
 
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import queue
 import re
+import sqlite3
+import threading
+import time
+import unicodedata
 
 import logging
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from sentence_transformers import SentenceTransformer
-import faiss
+from datetime import datetime
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from discord.ext import tasks
+import numpy as np
 
-from .bot import bot
-from .utils import strip_bot_mentions
+from . import model_worker
+from .backends import PROMPT_PREAMBLE, create_backend
+from .bot import bot, DATA_DIR
+from .utils import extract_emojis, find_contiguous_emoji_chains, strip_bot_mentions
 
 logger = logging.getLogger(__name__)
 
-MODEL_NAME = "mrfakename/Apriel-5B-Instruct-llamafied"
-EMB_MODEL_NAME = "all-MiniLM-L6-v2"
+# Model backend for generation, embeddings and token counts (see
+# guardian.backends): "huggingface", or "stub" for load tests without
+# model weights
+MODEL_BACKEND = os.getenv("HELMHUD_BACKEND", "huggingface").lower()
 
-_tokenizer = None
-_model = None
-_emb_model = None
-_index = None
-_memories: List[str] = []
+# Unix socket of an out-of-process model worker (python -m
+# guardian.model_worker) that runs the model backend. Unset runs it in
+# this process.
+MODEL_WORKER = os.getenv("HELMHUD_MODEL_WORKER", "")
 
+# Seconds between model warm-up attempts after a failure, doubling up to
+# the maximum
+WARMUP_RETRY_INITIAL = 10
+WARMUP_RETRY_MAX = 300
 
-def invalidate_index() -> None:
-    """Mark the in-memory FAISS index as stale."""
-    global _index
-    _index = None
+# Seconds a mention waits for retrieval before replying without memories
+RETRIEVAL_TIMEOUT = float(os.getenv("HELMHUD_RETRIEVAL_TIMEOUT", "3"))
 
+# Persisted embeddings, FAISS index and manifest, one directory per partition
+MEMORY_STORE_DIR = DATA_DIR / "memory_index"
+# Remories are indexed per guild, or per channel with
+# HELMHUD_MEMORY_PARTITION=channel. Remories stored before guild IDs were
+# recorded, and that can't be attributed to a guild, share a legacy partition.
+MEMORY_PARTITIONING = os.getenv("HELMHUD_MEMORY_PARTITION", "guild").lower()
+LEGACY_PARTITION = "legacy"
+# v2: vectors keyed by content ID rather than message ID
+MEMORY_STORE_VERSION = 2
+# Maximum remories embedded per background flush
+FLUSH_BATCH_SIZE = 256
 
-def _load_models():
-    global _tokenizer, _model, _emb_model
-    try:
-        if _tokenizer is None:
-            logger.info("Downloading tokenizer %s", MODEL_NAME)
-            _tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-        if _model is None:
-            logger.info("Downloading model %s", MODEL_NAME)
-            _model = AutoModelForCausalLM.from_pretrained(
-                MODEL_NAME, device_map="auto", torch_dtype="auto"
-            )
-        if _emb_model is None:
-            logger.info("Loading embedding model %s", EMB_MODEL_NAME)
-            _emb_model = SentenceTransformer(EMB_MODEL_NAME)
-    except OSError as e:
-        raise RuntimeError(
-            f"Failed to download model files for {MODEL_NAME}. "
-            "Ensure you have internet access and, if the model is gated, run "
-            "`huggingface-cli login` before starting the bot."
-        ) from e
+# Consolidation: every HELMHUD_CONSOLIDATE_INTERVAL_HOURS, loaded partitions
+# with at least HELMHUD_CONSOLIDATE_MIN_REMORIES remories older than
+# HELMHUD_CONSOLIDATE_AFTER_DAYS have that history clustered into at most
+# HELMHUD_CONSOLIDATE_CLUSTERS summary vectors. 0 days disables it.
+CONSOLIDATE_AFTER_DAYS = float(os.getenv("HELMHUD_CONSOLIDATE_AFTER_DAYS", "90"))
+CONSOLIDATE_MIN_REMORIES = int(os.getenv("HELMHUD_CONSOLIDATE_MIN_REMORIES", "5000"))
+CONSOLIDATE_CLUSTERS = int(os.getenv("HELMHUD_CONSOLIDATE_CLUSTERS", "1024"))
+CONSOLIDATE_INTERVAL_HOURS = float(os.getenv("HELMHUD_CONSOLIDATE_INTERVAL_HOURS", "24"))
+# Old remories per summary vector below the cap; faiss k-means wants at
+# least 39 training points per centroid
+CONSOLIDATE_CLUSTER_SIZE = 40
+
+# Re-ranking: how many nearest candidates each partition contributes, and
+# how similarity, recency (exponential decay with the given half-life),
+# author influence and blessed-chain status are blended into one score
+RERANK_CANDIDATES = int(os.getenv("HELMHUD_RERANK_CANDIDATES", "32"))
+RANK_SIMILARITY_WEIGHT = float(os.getenv("HELMHUD_RANK_SIMILARITY_WEIGHT", "1.0"))
+RANK_RECENCY_WEIGHT = float(os.getenv("HELMHUD_RANK_RECENCY_WEIGHT", "0.15"))
+RANK_RECENCY_HALF_LIFE_DAYS = float(os.getenv("HELMHUD_RANK_RECENCY_HALF_LIFE_DAYS", "30"))
+RANK_INFLUENCE_WEIGHT = float(os.getenv("HELMHUD_RANK_INFLUENCE_WEIGHT", "0.15"))
+RANK_INFLUENCE_SCALE = float(os.getenv("HELMHUD_RANK_INFLUENCE_SCALE", "100"))
+RANK_BLESSED_WEIGHT = float(os.getenv("HELMHUD_RANK_BLESSED_WEIGHT", "0.1"))
+RANK_LEXICAL_WEIGHT = float(os.getenv("HELMHUD_RANK_LEXICAL_WEIGHT", "0.5"))
+
+# BM25 parameters for the lexical index, and how many lexical candidates
+# each partition contributes to ranking
+BM25_K1 = float(os.getenv("HELMHUD_BM25_K1", "1.2"))
+BM25_B = float(os.getenv("HELMHUD_BM25_B", "0.75"))
+LEXICAL_CANDIDATES = int(os.getenv("HELMHUD_LEXICAL_CANDIDATES", "32"))
+# Query terms found in more than this fraction of a partition's remories
+# (and in over LEXICAL_COMMON_MIN_DOCS of them) are stop words in practice:
+# they barely move BM25 scores but dominate its cost, so they're skipped
+LEXICAL_MAX_DF = float(os.getenv("HELMHUD_LEXICAL_MAX_DF", "0.05"))
+LEXICAL_COMMON_MIN_DOCS = 1000
+
+# Approximate nearest-neighbour tiers. Below ANN_THRESHOLD remories the index
+# is an exact flat scan; above it the index is retrained as IVF-Flat (or
+# HNSW when HELMHUD_ANN_KIND=hnsw), and above ANN_PQ_THRESHOLD as IVF-PQ.
+# Defaults come from benchmarks/ann_recall.py.
+ANN_THRESHOLD = int(os.getenv("HELMHUD_ANN_THRESHOLD", "200000"))
+ANN_PQ_THRESHOLD = int(os.getenv("HELMHUD_ANN_PQ_THRESHOLD", "2000000"))
+ANN_KIND = os.getenv("HELMHUD_ANN_KIND", "ivf").lower()
+ANN_NPROBE = int(os.getenv("HELMHUD_ANN_NPROBE", "32"))
+ANN_EF_SEARCH = int(os.getenv("HELMHUD_ANN_EF_SEARCH", "128"))
+ANN_HNSW_M = int(os.getenv("HELMHUD_ANN_HNSW_M", "32"))
+
+# Embeddings kept in memory by the content-hash cache, and whether to
+# back it with an on-disk SQLite tier in DATA_DIR
+EMBED_CACHE_SIZE = int(os.getenv("HELMHUD_EMBED_CACHE_SIZE", "50000"))
+EMBED_CACHE_DISK = os.getenv("HELMHUD_EMBED_CACHE_DISK", "").lower() in ("1", "true", "yes")
+
+# Micro-batching for the embedding worker: texts per encode call, how long
+# the first request in a batch may wait for company, and how many requests
+# may queue before new ones are rejected
+EMBED_BATCH_SIZE = int(os.getenv("HELMHUD_EMBED_BATCH_SIZE", "64"))
+EMBED_BATCH_WAIT = float(os.getenv("HELMHUD_EMBED_BATCH_WAIT_MS", "10")) / 1000
+EMBED_QUEUE_SIZE = int(os.getenv("HELMHUD_EMBED_QUEUE_SIZE", "256"))
+
+# Generation scheduling: model.generate calls allowed at once, mentions
+# that may wait for a slot, and how many of those one user may hold
+GENERATION_CONCURRENCY = int(os.getenv("HELMHUD_GENERATION_CONCURRENCY", "1"))
+GENERATION_QUEUE_SIZE = int(os.getenv("HELMHUD_GENERATION_QUEUE_SIZE", "8"))
+GENERATION_USER_LIMIT = int(os.getenv("HELMHUD_GENERATION_USER_LIMIT", "2"))
+# Prompts decoded together in one left-padded batch, and how long the
+# oldest waiting prompt may hold a free slot for others to join it
+GENERATION_BATCH_SIZE = int(os.getenv("HELMHUD_GENERATION_BATCH_SIZE", "4"))
+GENERATION_BATCH_WAIT = float(os.getenv("HELMHUD_GENERATION_BATCH_WAIT_MS", "50")) / 1000
+# Seconds a mention may take from queueing to its last token (0 for no
+# limit), and the reply length new batches shrink toward as the queue fills
+GENERATION_TIMEOUT = float(os.getenv("HELMHUD_GENERATION_TIMEOUT", "120"))
+GENERATION_MIN_TOKENS = int(os.getenv("HELMHUD_GENERATION_MIN_TOKENS", "64"))
+
+# Token budgets for the variable prompt sections. Budget the query and
+# memories leave unused goes to the recent conversation.
+PROMPT_CONVERSATION_TOKENS = int(os.getenv("HELMHUD_PROMPT_CONVERSATION_TOKENS", "384"))
+PROMPT_MEMORY_TOKENS = int(os.getenv("HELMHUD_PROMPT_MEMORY_TOKENS", "256"))
+PROMPT_QUERY_TOKENS = int(os.getenv("HELMHUD_PROMPT_QUERY_TOKENS", "256"))
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("HELMHUD_TOKEN_COUNT_CACHE_SIZE", "20000"))
+
+# Per-guild cache of replies keyed by query embedding: minimum cosine
+# similarity for a hit, entry lifetime in seconds and entries per guild
+RESPONSE_CACHE = os.getenv("HELMHUD_RESPONSE_CACHE", "1").lower() not in ("0", "false", "no")
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("HELMHUD_RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL = float(os.getenv("HELMHUD_RESPONSE_CACHE_TTL", "21600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("HELMHUD_RESPONSE_CACHE_SIZE", "256"))
+
+
+
+def _create_backend():
+    if MODEL_WORKER:
+        # The worker reports its own backend's embedding space
+        return model_worker.client(MODEL_WORKER)
+    return create_backend(MODEL_BACKEND, PROMPT_PREAMBLE)
+
+
+_backend = _create_backend()
+
+# Embedding and FAISS work runs here so it never blocks the event loop
+_retrieval_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="helmhud-retrieval"
+)
+# Index retrains are built here, then swapped in on the retrieval executor
+_index_build_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="helmhud-index-build"
+)
+# Partition snapshots are written to disk here, one at a time
+_index_save_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="helmhud-index-save"
+)
 
 
 def ensure_model_downloaded() -> None:
-    """Ensure the tokenizer, model and embedding model are loaded."""
-    global _tokenizer, _model, _emb_model
+    """Ensure the model backend is loaded.
+
+    Blocking; the bot calls it through :func:`start_model_warmup`. With
+    ``HELMHUD_MODEL_WORKER`` set this waits until the worker answers.
+    """
+    if not _backend.is_cached():
+        logger.info("Model files not found locally, downloading...")
+    started = time.perf_counter()
+    _backend.load()
+    logger.info("Models ready (%s) in %.1fs", _backend.name, time.perf_counter() - started)
+
+
+_warmup_task: Optional[asyncio.Task] = None
+# Why the last warm-up attempt failed, until one succeeds
+_warmup_error: Optional[str] = None
 
-    if _tokenizer is not None and _model is not None and _emb_model is not None:
+
+async def _warm_up() -> None:
+    """Load the models, retrying failures with backoff until they load."""
+    global _warmup_error
+    delay = WARMUP_RETRY_INITIAL
+    while True:
+        try:
+            await asyncio.to_thread(ensure_model_downloaded)
+        except Exception as e:
+            _warmup_error = f"{type(e).__name__}: {e}"
+            logger.error("Model warm-up failed; retrying in %ds", delay, exc_info=True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_RETRY_MAX)
+        else:
+            _warmup_error = None
+            return
+
+
+def start_model_warmup() -> None:
+    """Load the models in the background, once; safe to call on every on_ready."""
+    global _warmup_task
+    if _warmup_task is not None and not (
+        _warmup_task.done() and (_warmup_task.cancelled() or _warmup_task.exception())
+    ):
         return
+    _warmup_task = asyncio.ensure_future(_warm_up())
+    _warmup_task.add_done_callback(_warmup_done)
+
+
+def _warmup_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Model warm-up failed", exc_info=task.exception())
+
+
+def model_ready() -> bool:
+    """Whether warm-up has finished and mentions can be answered."""
+    return (
+        _warmup_task is not None
+        and _warmup_task.done()
+        and not _warmup_task.cancelled()
+        and _warmup_task.exception() is None
+    )
+
+
+def model_warmup_error() -> Optional[str]:
+    """Why loading the models last failed while warm-up keeps retrying, else ``None``."""
+    return None if model_ready() else _warmup_error
+
+
+def _save_npy(path: Path, array) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
 
+
+# Written next to a partition's index once it has been consolidated
+_ARCHIVE_FILES = ("summaries.json", "archive_embeddings.npy", "archive_ids.npy")
+
+
+def _write_snapshot(path: Path, snapshot: dict) -> None:
+    """Write a :meth:`MemoryIndex.snapshot` to ``path``, or clear it if empty."""
+    path.mkdir(parents=True, exist_ok=True)
+    if snapshot["empty"]:
+        for name in ("manifest.json", "embeddings.npy", "ids.npy", "index.faiss") + _ARCHIVE_FILES:
+            (path / name).unlink(missing_ok=True)
+        return
     try:
-        # Check for cached files without loading them in memory
-        AutoTokenizer.from_pretrained(MODEL_NAME, local_files_only=True)
-        AutoModelForCausalLM.from_pretrained(MODEL_NAME, local_files_only=True)
-        SentenceTransformer(EMB_MODEL_NAME)
-        logger.info("Model files already present; loading")
-    except OSError:
-        logger.info("Model files not found locally, downloading...")
+        if snapshot["members"] is None:
+            for name in _ARCHIVE_FILES:
+                (path / name).unlink(missing_ok=True)
+        else:
+            if snapshot["archive_changed"] or not (path / "archive_ids.npy").exists():
+                _save_npy(path / "archive_embeddings.npy", snapshot["archive"])
+                _save_npy(path / "archive_ids.npy", snapshot["archive_ids"])
+            tmp = path / "summaries.json.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snapshot["members"], f)
+            os.replace(tmp, path / "summaries.json")
+        _save_npy(path / "embeddings.npy", snapshot["vectors"])
+        _save_npy(path / "ids.npy", snapshot["ids"])
+        index = snapshot["index"]
+        if index is None:
+            index = build_faiss_index(snapshot["vectors"], snapshot["ids"], "flat")
+    finally:
+        # The shared vectors are no longer read
+        snapshot["written"].set()
+    import faiss
+
+    tmp = path / "index.faiss.tmp"
+    faiss.write_index(index, str(tmp))
+    os.replace(tmp, path / "index.faiss")
+    tmp = path / "manifest.json.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot["manifest"], f, indent=2)
+    os.replace(tmp, path / "manifest.json")
+
+
+_INDEX_TIERS = {"flat": 0, "ivf_flat": 1, "hnsw": 1, "ivf_pq": 2}
+
+
+def choose_index_kind(count: int) -> str:
+    """Return the FAISS index kind to use for a corpus of ``count`` vectors."""
+    if count < ANN_THRESHOLD:
+        return "flat"
+    if ANN_KIND == "hnsw":
+        return "hnsw"
+    if count >= ANN_PQ_THRESHOLD:
+        return "ivf_pq"
+    return "ivf_flat"
+
+
+def _ivf_lists(count: int) -> int:
+    return int(min(65536, max(16, 4 * math.sqrt(count))))
+
+
+def _pq_subquantizers(dim: int) -> int:
+    """Largest number of sub-quantizers dividing ``dim`` with >= 8 dims each."""
+    for m in range(max(1, dim // 8), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def configure_search(index, kind: str, nprobe: int = None, ef_search: int = None) -> None:
+    """Apply the tunable search parameters for ``kind`` to ``index``."""
+    import faiss
+
+    params = faiss.ParameterSpace()
+    if kind in ("ivf_flat", "ivf_pq"):
+        params.set_index_parameter(index, "nprobe", nprobe or ANN_NPROBE)
+    elif kind == "hnsw":
+        params.set_index_parameter(index, "efSearch", ef_search or ANN_EF_SEARCH)
+
+
+def build_faiss_index(vectors, ids, kind: Optional[str] = None):
+    """Build a FAISS index holding ``vectors`` under ``ids``.
+
+    ``kind`` defaults to :func:`choose_index_kind` for the corpus size. IVF
+    indexes are trained on a random sample of the vectors.
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    count, dim = vectors.shape
+    kind = kind or choose_index_kind(count)
+    if kind in ("ivf_flat", "ivf_pq"):
+        nlist = _ivf_lists(count)
+        quantizer = faiss.IndexFlatL2(dim)
+        if kind == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_subquantizers(dim), 8)
+        sample = min(count, 64 * nlist)
+        rows = np.random.default_rng(0).choice(count, sample, replace=False)
+        index.train(vectors[np.sort(rows)])
+    elif kind == "hnsw":
+        index = faiss.IndexIDMap2(faiss.IndexHNSWFlat(dim, ANN_HNSW_M))
+    else:
+        kind = "flat"
+        index = faiss.IndexIDMap(faiss.IndexFlatL2(dim))
+    configure_search(index, kind)
+    if count:
+        index.add_with_ids(vectors, np.asarray(ids, dtype="int64"))
+    return index
+
+
+_CUSTOM_EMOJI = re.compile(r"<a?:\w+?:\d+>")
+_WORD = re.compile(r"[^\W_]{2,}")
+
+
+def lexical_terms(text: str, chains: Iterable[str] = ()) -> Tuple[Counter, Set[str]]:
+    """Return term counts for ``text`` and which of the terms are emoji chains.
+
+    Terms are lowercased words, individual emojis and contiguous emoji
+    chains (joined into their chain key), plus any extra chain keys given.
+    """
+    terms = Counter(_WORD.findall(_CUSTOM_EMOJI.sub(" ", _normalize_text(text).lower())))
+    terms.update(extract_emojis(text))
+    chain_keys = {"".join(chain) for chain in find_contiguous_emoji_chains(text)}
+    chain_keys.update(chain for chain in chains if chain)
+    terms.update(chain_keys)
+    return terms, chain_keys
+
+
+class LexicalIndex:
+    """BM25 inverted index over remory words, emojis and emoji chain keys.
+
+    Lives alongside a :class:`MemoryIndex` and is keyed by the same content
+    IDs. It is rebuilt from texts on load rather than persisted.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self.lengths: Dict[int, int] = {}
+        self._terms: Dict[int, Counter] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, memory_id: int, terms: Counter) -> None:
+        """Index ``terms`` for ``memory_id``, merging with terms already held."""
+        current = self._terms.setdefault(memory_id, Counter())
+        new = {term: n for term, n in terms.items() if term not in current}
+        if not new and memory_id in self.lengths:
+            return
+        current.update(new)
+        for term, n in new.items():
+            self.postings[term][memory_id] = n
+        length = sum(current.values())
+        self._total_length += length - self.lengths.get(memory_id, 0)
+        self.lengths[memory_id] = length
+
+    def remove(self, memory_id: int) -> None:
+        for term in self._terms.pop(memory_id, ()):
+            docs = self.postings[term]
+            docs.pop(memory_id, None)
+            if not docs:
+                del self.postings[term]
+        self._total_length -= self.lengths.pop(memory_id, 0)
+
+    def matching(self, terms: Iterable[str]) -> Set[int]:
+        """Return the IDs containing any of ``terms``."""
+        found = set()
+        for term in terms:
+            found.update(self.postings.get(term, ()))
+        return found
+
+    def search(self, terms: Counter, k: int) -> Tuple[List[Tuple[float, int]], int]:
+        """Return the top ``k`` ``(score, memory_id)`` pairs and how many IDs match every term.
+
+        Terms too common to be worth scoring (see ``LEXICAL_MAX_DF``) are
+        left out of both.
+        """
+        n = len(self.lengths)
+        common = max(LEXICAL_MAX_DF * n, LEXICAL_COMMON_MIN_DOCS)
+        terms = [term for term in terms if len(self.postings.get(term, ())) <= common]
+        if not n or not terms:
+            return [], 0
+        average = self._total_length / n
+        ids, partial = [], []
+        for term in terms:
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            term_ids = np.fromiter(docs.keys(), dtype="int64", count=len(docs))
+            tf = np.fromiter(docs.values(), dtype="float64", count=len(docs))
+            lengths = np.fromiter(map(self.lengths.__getitem__, docs), dtype="float64", count=len(docs))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average)
+            ids.append(term_ids)
+            partial.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        if not ids:
+            return [], 0
+        unique, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(partial))
+        complete = int(np.count_nonzero(np.bincount(inverse) == len(terms)))
+        top = np.lexsort((-unique, -scores))[:k]
+        top = [(float(scores[i]), int(unique[i])) for i in top]
+        return top, complete
+
+
+class MemoryIndex:
+    """FAISS index of remory embeddings keyed by content ID.
+
+    Identical texts share one vector; ``refs`` tracks which remories (by
+    remory ID, with author, timestamp and chain) point at each content ID,
+    and a vector is dropped once its last remory is detached. Vectors live
+    in an ID-mapped FAISS index so they can be added and removed one at a
+    time. The raw embeddings are also kept in a row-major matrix (with a
+    row to content ID array) so they can be persisted, memory mapped back in
+    on startup and used to retrain the index when the corpus grows into an
+    approximate tier. Only the retrieval executor thread mutates an
+    instance.
+
+    Old history can be consolidated into summary vectors: ``members`` maps
+    each summary's ID to the content IDs it stands for, nearest its centroid
+    first, and the summary is shown as the first remaining member's text.
+    Member vectors are archived so later consolidations recluster from the
+    raw embeddings; refs on a summary carry the member as a fourth field.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.kind = "flat"
+        # HNSW can't delete vectors; removed IDs stay in the graph until retrain
+        self.tombstones = 0
+        self.texts: Dict[int, str] = {}
+        self.refs: Dict[int, Dict[int, tuple]] = {}
+        self._owners: Dict[int, int] = {}
+        self.lexical = LexicalIndex()
+        self.dim: Optional[int] = None
+        self.dirty = False
+        self._vectors = None
+        self._ids = None
+        self._rows: Dict[int, int] = {}
+        self._building = False
+        # Set once the last snapshot's files are written
+        self._saving: Optional[threading.Event] = None
+        self.members: Dict[int, List[int]] = {}
+        self.absorbed: Dict[int, int] = {}
+        self._member_texts: Dict[int, str] = {}
+        self._archive = None
+        self._archive_rows: Dict[int, int] = {}
+        self._archive_dirty = False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, memory_id):
+        return memory_id in self._rows
+
+    def _reserve(self, extra: int) -> None:
+        size = len(self._rows)
+        capacity = 0 if self._vectors is None else self._vectors.shape[0]
+        if size + extra <= capacity:
+            return
+        capacity = max(size + extra, capacity * 2, 1024)
+        vectors = np.empty((capacity, self.dim), dtype="float32")
+        ids = np.empty(capacity, dtype="int64")
+        if size:
+            vectors[:size] = self._vectors[:size]
+            ids[:size] = self._ids[:size]
+        self._vectors, self._ids = vectors, ids
+
+    def add(self, ids: List[int], texts: List[str], embeddings) -> None:
+        if not ids:
+            return
+        embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+        for memory_id in ids:
+            # Consolidated text said again is recent, so it gets its own vector
+            self._release(memory_id)
+        if self.index is None:
+            self.dim = embeddings.shape[1]
+            self.index = build_faiss_index(np.empty((0, self.dim), dtype="float32"), [], "flat")
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f"Embedding dimension {embeddings.shape[1]} does not match index dimension {self.dim}"
+            )
+        self._reserve(len(ids))
+        start = len(self._rows)
+        self._vectors[start:start + len(ids)] = embeddings
+        self._ids[start:start + len(ids)] = ids
+        self._rows.update((memory_id, start + n) for n, memory_id in enumerate(ids))
+        self.index.add_with_ids(embeddings, np.asarray(ids, dtype="int64"))
+        self.texts.update(zip(ids, texts))
+        for memory_id, text in zip(ids, texts):
+            self.lexical.add(memory_id, lexical_terms(text)[0])
+        self.dirty = True
+        if _INDEX_TIERS[choose_index_kind(len(self))] > _INDEX_TIERS[self.kind]:
+            self.retrain_in_background()
+
+    def retrain(self, kind: Optional[str] = None) -> None:
+        """Rebuild the FAISS index from the stored vectors, blocking.
+
+        Used when a stored index can't be read; nothing is re-encoded.
+        """
+        size = len(self._rows)
+        kind = kind or choose_index_kind(size)
+        started = time.monotonic()
+        self.index = build_faiss_index(self._vectors[:size], self._ids[:size], kind)
+        self.kind = kind
+        self.tombstones = 0
+        self.dirty = True
+        logger.info(
+            "Memory index retrained as %s over %d remories in %.1fs",
+            kind, size, time.monotonic() - started,
+        )
+
+    def retrain_in_background(self, kind: Optional[str] = None) -> None:
+        """Rebuild the FAISS index off the retrieval executor.
+
+        Used to move into an approximate tier as the corpus grows and to
+        purge HNSW tombstones. Training IVF on a large corpus takes minutes,
+        so a snapshot of the vectors is indexed on the index build thread
+        while this index keeps serving, and the result is swapped in on the
+        retrieval executor with the changes made meanwhile replayed. Only
+        one rebuild per instance runs at a time.
+        """
+        if self._building:
+            return
+        size = len(self._rows)
+        kind = kind or choose_index_kind(size)
+        self._building = True
+        vectors = np.array(self._vectors[:size])
+        ids = np.array(self._ids[:size])
+        started = time.monotonic()
+
+        def _build():
+            try:
+                index = build_faiss_index(vectors, ids, kind)
+            except Exception:
+                logger.exception("Memory index retrain as %s failed", kind)
+                _retrieval_executor.submit(setattr, self, "_building", False)
+                return
+            _retrieval_executor.submit(self._swap_in, index, kind, ids, started)
 
-    _load_models()
+        _index_build_executor.submit(_build)
 
+    def _swap_in(self, index, kind: str, built_ids, started: float) -> None:
+        built = set(built_ids.tolist())
+        added = [i for i in self._rows if i not in built]
+        removed = [i for i in built if i not in self._rows]
+        if added:
+            rows = [self._rows[i] for i in added]
+            index.add_with_ids(self._vectors[rows], np.asarray(added, dtype="int64"))
+        tombstones = 0
+        if removed:
+            if kind == "hnsw":
+                tombstones = len(removed)
+            else:
+                index.remove_ids(np.asarray(removed, dtype="int64"))
+        self.index, self.kind, self.tombstones = index, kind, tombstones
+        self._building = False
+        self.dirty = True
+        logger.info(
+            "Memory index retrained as %s over %d remories in %.1fs (%d added, %d removed meanwhile)",
+            kind, len(built), time.monotonic() - started, len(added), len(removed),
+        )
+        if _INDEX_TIERS[choose_index_kind(len(self))] > _INDEX_TIERS[self.kind]:
+            self.retrain_in_background()
+        elif self.tombstones > len(self._rows) // 5:
+            self.retrain_in_background(self.kind)
 
-def _build_index():
-    global _index, _memories
-    remories = []
+    def remove(self, ids: Iterable[int]) -> None:
+        ids = [i for i in ids if i in self._rows]
+        if not ids:
+            return
+        self._unshare()
+        if self.kind == "hnsw":
+            self.tombstones += len(ids)
+        else:
+            self.index.remove_ids(np.asarray(ids, dtype="int64"))
+        for memory_id in ids:
+            # Move the last row into the hole to keep the matrix dense
+            row = self._rows.pop(memory_id)
+            last = len(self._rows)
+            if row != last:
+                moved = int(self._ids[last])
+                self._vectors[row] = self._vectors[last]
+                self._ids[row] = moved
+                self._rows[moved] = row
+            self.texts.pop(memory_id, None)
+            self.lexical.remove(memory_id)
+            for remory in self.refs.pop(memory_id, {}):
+                self._owners.pop(remory, None)
+            for member in self.members.pop(memory_id, ()):
+                self.absorbed.pop(member, None)
+                self._member_texts.pop(member, None)
+                self._archive_dirty = True
+        self.dirty = True
+        if self.tombstones > len(self._rows) // 5:
+            self.retrain_in_background(self.kind)
+
+    def attach(self, memory_id: int, refs: Dict[int, tuple]) -> None:
+        """Point remories (remory ID -> author, timestamp, chain) at a vector."""
+        for remory, meta in refs.items():
+            previous = self._owners.get(remory)
+            if previous is not None and previous != memory_id:
+                self.detach([remory])
+            self._owners[remory] = memory_id
+            self.refs.setdefault(memory_id, {})[remory] = meta
+            if meta[2] and memory_id in self.texts:
+                self.lexical.add(memory_id, Counter({meta[2]: 1}))
+
+    def set_refs(self, entries: Dict[int, Tuple[str, Dict[int, tuple]]]) -> None:
+        """Replace texts and references from a ``content ID -> (text, refs)`` snapshot."""
+        self.texts = {i: entries[i][0] for i in self._rows}
+        self.refs = {i: dict(entries[i][1]) for i in self._rows}
+        self._owners = {r: i for i, refs in self.refs.items() for r in refs}
+        self.lexical = LexicalIndex()
+        for memory_id, text in self.texts.items():
+            chains = (meta[2] for meta in self.refs[memory_id].values())
+            self.lexical.add(memory_id, lexical_terms(text, chains)[0])
+
+    def detach(self, remories: Iterable[int]) -> None:
+        """Unlink remories, removing vectors no remory points at any more."""
+        orphaned = []
+        for remory in remories:
+            memory_id = self._owners.pop(remory, None)
+            if memory_id is None:
+                continue
+            refs = self.refs.get(memory_id, {})
+            refs.pop(remory, None)
+            if not refs:
+                orphaned.append(memory_id)
+            elif memory_id in self.members:
+                live = {meta[3] for meta in refs.values() if len(meta) > 3}
+                self._keep_members(memory_id, live)
+        self.remove(orphaned)
+
+    def _keep_members(self, summary_id: int, live) -> None:
+        """Drop a summary's members not in ``live`` and re-pick its text."""
+        members = self.members[summary_id]
+        kept = [m for m in members if m in live]
+        if len(kept) == len(members):
+            return
+        for member in members:
+            if member not in live:
+                self.absorbed.pop(member, None)
+                self._member_texts.pop(member, None)
+        self.members[summary_id] = kept
+        self._archive_dirty = self.dirty = True
+        text = self._member_texts.get(kept[0]) if kept else None
+        if text is not None and text != self.texts.get(summary_id):
+            self.texts[summary_id] = text
+            chains = (meta[2] for meta in self.refs.get(summary_id, {}).values())
+            self.lexical.remove(summary_id)
+            self.lexical.add(summary_id, lexical_terms(text, chains)[0])
+
+    def _release(self, member: int) -> None:
+        summary_id = self.absorbed.get(member)
+        if summary_id is not None:
+            self._keep_members(summary_id, set(self.members[summary_id]) - {member})
+
+    def fold(self, entries: Dict[int, Tuple[str, Dict[int, tuple]]]) -> Dict[int, Tuple[str, Dict[int, tuple]]]:
+        """Map a ``content ID -> (text, refs)`` snapshot onto this index's vectors.
+
+        Consolidated content is merged into its summary's entry, and members
+        missing from the snapshot are dropped; a summary left without
+        members is missing from the result, so a sync removes it.
+        """
+        folded = {}
+        grouped = defaultdict(dict)
+        for memory_id, entry in entries.items():
+            summary_id = self.absorbed.get(memory_id)
+            if summary_id is None:
+                folded[memory_id] = entry
+            else:
+                grouped[summary_id][memory_id] = entry
+        for summary_id in list(self.members):
+            found = grouped.get(summary_id, {})
+            self._member_texts.update((m, entry[0]) for m, entry in found.items())
+            self._keep_members(summary_id, found)
+            kept = self.members[summary_id]
+            if kept:
+                refs = {
+                    remory: meta + (member,)
+                    for member in kept
+                    for remory, meta in found[member][1].items()
+                }
+                folded[summary_id] = (found[kept[0]][0], refs)
+        return folded
+
+    def consolidation_input(self, cutoff: float) -> Tuple[List[int], Optional[np.ndarray]]:
+        """Return the old remories' content IDs and raw vectors for clustering.
+
+        That is every vector last referenced before ``cutoff`` plus every
+        archived member; the vectors are ``None`` unless at least
+        ``CONSOLIDATE_MIN_REMORIES`` of the former are still exact.
+        """
+        old = [i for i in self._rows if i not in self.members and self._newest(i) < cutoff]
+        if len(old) < max(1, CONSOLIDATE_MIN_REMORIES):
+            return old, None
+        archived = list(self.absorbed)
+        vectors = self._vectors[[self._rows[i] for i in old]]
+        if archived:
+            vectors = np.concatenate(
+                [vectors, self._archive[[self._archive_rows[m] for m in archived]]]
+            )
+        return old + archived, np.ascontiguousarray(vectors, dtype="float32")
+
+    def consolidate(self, ids: List[int], vectors, centroids, labels, cutoff: float) -> int:
+        """Replace ``ids`` (from :meth:`consolidation_input`) with summary vectors.
+
+        ``labels`` assigns each vector to a row of ``centroids``. Remories
+        forgotten, or repeated, since the input was taken are left out. The
+        raw vectors become the new archive. Returns the number of summaries.
+        """
+        member_refs = defaultdict(dict)
+        for summary_id in self.members:
+            for remory, meta in self.refs.get(summary_id, {}).items():
+                if len(meta) > 3:
+                    member_refs[meta[3]][remory] = meta[:3]
+        texts = {}
+        exact = []
+        for memory_id in ids:
+            if memory_id in self.absorbed:
+                texts[memory_id] = self._member_texts.get(memory_id)
+            elif (
+                memory_id in self._rows
+                and memory_id not in self.members
+                and self._newest(memory_id) < cutoff
+            ):
+                texts[memory_id] = self.texts[memory_id]
+                member_refs[memory_id] = dict(self.refs[memory_id])
+                exact.append(memory_id)
+        diff = vectors - centroids[labels]
+        distances = np.einsum("ij,ij->i", diff, diff)
+        clusters = defaultdict(list)
+        for n, memory_id in enumerate(ids):
+            if texts.get(memory_id) is not None and member_refs.get(memory_id):
+                clusters[int(labels[n])].append((float(distances[n]), memory_id, n))
+
+        self.remove(list(self.members) + exact)
+        summary_ids, summary_texts, summary_rows, archived = [], [], [], []
+        for label, members in clusters.items():
+            members.sort()
+            summary_id = _summary_id(m for _, m, _ in members)
+            summary_ids.append(summary_id)
+            summary_texts.append(texts[members[0][1]])
+            summary_rows.append(label)
+            self.members[summary_id] = [m for _, m, _ in members]
+            archived.extend(members)
+        self.add(summary_ids, summary_texts, centroids[summary_rows])
+        for summary_id in summary_ids:
+            refs = {}
+            for member in self.members[summary_id]:
+                self.absorbed[member] = summary_id
+                self._member_texts[member] = texts[member]
+                refs.update((r, meta + (member,)) for r, meta in member_refs[member].items())
+            self.attach(summary_id, refs)
+        self._archive = vectors[[n for _, _, n in archived]]
+        self._archive_rows = {m: row for row, (_, m, _) in enumerate(archived)}
+        self._archive_dirty = True
+        if choose_index_kind(len(self)) != self.kind:
+            self.retrain_in_background()
+        return len(summary_ids)
+
+    def _newest(self, memory_id: int) -> float:
+        return max((meta[1] for meta in self.refs.get(memory_id, {}).values()), default=0.0)
+
+    def candidate(self, memory_id: int) -> Tuple[str, float, List[int], List[str]]:
+        """Return text, newest timestamp, authors and chain keys for a vector."""
+        refs = self.refs.get(memory_id, {}).values()
+        newest = max((meta[1] for meta in refs), default=0.0)
+        authors = sorted({meta[0] for meta in refs if meta[0] is not None})
+        chains = sorted({meta[2] for meta in refs if meta[2]})
+        return self.texts[memory_id], newest, authors, chains
+
+    def distance(self, memory_id: int, embedding) -> float:
+        """Exact squared L2 distance from ``embedding`` to a stored vector."""
+        diff = self._vectors[self._rows[memory_id]] - embedding[0]
+        return float(np.dot(diff, diff))
+
+    def search(self, embedding, k: int) -> List[Tuple[float, int]]:
+        """Return up to ``k`` ``(distance, memory_id)`` pairs, nearest first."""
+        if self.index is None or not self._rows:
+            return []
+        # Over-fetch past HNSW tombstones, which search still returns
+        fetch = min(k + self.tombstones, self.index.ntotal)
+        scores, idx = self.index.search(embedding, fetch)
+        hits = [(float(d), int(i)) for d, i in zip(scores[0], idx[0]) if i in self.texts]
+        return hits[:k]
+
+    def snapshot(self) -> dict:
+        """Capture what a save writes, for :func:`_write_snapshot` on another thread.
+
+        Marks the index clean. The vector and ID arrays are shared rather
+        than copied: adds only fill rows past the snapshot, and a removal
+        copies them first while the save is still being written. ANN
+        indexes are cloned; a flat index is rebuilt from the vectors by the
+        writer, so snapshotting one costs next to nothing.
+        """
+        self.dirty = False
+        if self.index is None:
+            return {"empty": True}
+        import faiss
+
+        size = len(self._rows)
+        self._saving = threading.Event()
+        snapshot = {
+            "empty": False,
+            "index": None if self.kind == "flat" else faiss.clone_index(self.index),
+            "vectors": self._vectors[:size],
+            "ids": self._ids[:size],
+            "manifest": {
+                "version": MEMORY_STORE_VERSION,
+                "model": _backend.embedding_name,
+                "dim": self.dim,
+                "count": size,
+                "kind": self.kind,
+                "tombstones": self.tombstones,
+                "saved": datetime.now().isoformat(),
+            },
+            "written": self._saving,
+            "members": None,
+        }
+        if self.members:
+            if self._archive_dirty:
+                # Forgotten members' vectors are dropped, not just unlinked
+                archived = list(self.absorbed)
+                self._archive = np.asarray(
+                    self._archive[[self._archive_rows[m] for m in archived]], dtype="float32"
+                )
+                self._archive_rows = {m: row for row, m in enumerate(archived)}
+            # The archive is replaced, never written in place
+            snapshot.update(
+                members={str(i): list(members) for i, members in self.members.items()},
+                archive=self._archive,
+                archive_ids=np.asarray(
+                    sorted(self._archive_rows, key=self._archive_rows.get), dtype="int64"
+                ),
+                archive_changed=self._archive_dirty,
+            )
+        self._archive_dirty = False
+        return snapshot
+
+    def _unshare(self) -> None:
+        """Copy the vectors before rows a save is still writing change."""
+        if self._saving is not None and not self._saving.is_set():
+            self._vectors, self._ids = self._vectors.copy(), self._ids.copy()
+        self._saving = None
+
+    def _load_archive(self, path: Path) -> bool:
+        """Read summary members and the archive; False if they don't match the index."""
+        if not (path / "summaries.json").exists():
+            return True
+        try:
+            with open(path / "summaries.json", "r", encoding="utf-8") as f:
+                members = {int(i): [int(m) for m in ms] for i, ms in json.load(f).items()}
+            archive = np.load(path / "archive_embeddings.npy", mmap_mode="c")
+            ids = np.load(path / "archive_ids.npy")
+        except (OSError, ValueError) as e:
+            logger.warning("Unreadable memory archive, re-embedding: %s", e)
+            return False
+        rows = {int(m): row for row, m in enumerate(ids)}
+        if archive.shape != (len(ids), self.dim) or any(
+            i not in self._rows or any(m not in rows for m in ms) for i, ms in members.items()
+        ):
+            logger.warning("Memory archive does not match the index, re-embedding")
+            return False
+        self.members = members
+        self.absorbed = {m: i for i, ms in members.items() for m in ms}
+        self._archive, self._archive_rows = archive, rows
+        return True
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["MemoryIndex"]:
+        """Map a saved index back in, or return ``None`` if missing or stale.
+
+        The embeddings matrix is memory mapped copy-on-write, so pages are
+        only read as the index touches them. If the FAISS file is unreadable
+        the index is rebuilt from the stored vectors without re-encoding.
+        """
+        try:
+            with open(path / "manifest.json", "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Unreadable memory index manifest, re-embedding: %s", e)
+            return None
+
+        if manifest.get("version") != MEMORY_STORE_VERSION or manifest.get("model") != _backend.embedding_name:
+            logger.info(
+                "Stored memory index was built with %s (v%s); re-embedding with %s",
+                manifest.get("model"), manifest.get("version"), _backend.embedding_name,
+            )
+            return None
+
+        try:
+            vectors = np.load(path / "embeddings.npy", mmap_mode="c")
+            ids = np.array(np.load(path / "ids.npy"), dtype="int64")
+        except (OSError, ValueError) as e:
+            logger.warning("Unreadable memory embeddings, re-embedding: %s", e)
+            return None
+        count, dim = manifest.get("count"), manifest.get("dim")
+        if vectors.shape != (count, dim) or ids.shape != (count,):
+            logger.warning("Memory embeddings do not match manifest, re-embedding")
+            return None
+
+        self = cls()
+        self.dim = dim
+        self.kind = manifest.get("kind", "flat")
+        self.tombstones = manifest.get("tombstones", 0)
+        self._vectors, self._ids = vectors, ids
+        self._rows = {int(memory_id): row for row, memory_id in enumerate(ids)}
+        if not self._load_archive(path):
+            return None
+        try:
+            import faiss
+
+            self.index = faiss.read_index(str(path / "index.faiss"))
+            if self.index.ntotal != count + self.tombstones or self.index.d != dim:
+                raise ValueError("index does not match manifest")
+            configure_search(self.index, self.kind)
+        except Exception as e:
+            logger.warning("Rebuilding FAISS index from stored embeddings: %s", e)
+            self.retrain(self.kind)
+        logger.info("Loaded %d stored memory embeddings", count)
+        return self
+
+
+_partitions: Dict[str, MemoryIndex] = {}
+_synced_partitions: Set[str] = set()
+_partition_syncs: Dict[str, asyncio.Future] = {}
+# Remories waiting to be embedded per partition, filled on the loop and
+# drained by the executor
+_pending_memories: Dict[str, Dict[int, tuple]] = defaultdict(dict)
+_flush_future: Optional[asyncio.Future] = None
+_remories_attributed = False
+# Queries answered by the lexical index with and without embedding
+_lexical_stats: Counter = Counter()
+# Completed consolidation runs
+_consolidation_stats: Counter = Counter()
+
+
+def partition_key(guild_id=None, channel_id=None) -> str:
+    """Return the index partition for a guild (and channel)."""
+    if guild_id is None:
+        return LEGACY_PARTITION
+    if MEMORY_PARTITIONING == "channel" and channel_id is not None:
+        return f"{guild_id}-{channel_id}"
+    return str(guild_id)
+
+
+def query_partitions(guild_id=None, channel_id=None) -> List[str]:
+    """Return the partitions a query from this guild/channel should search."""
+    keys = [partition_key(guild_id, channel_id), partition_key(guild_id), LEGACY_PARTITION]
+    return list(dict.fromkeys(keys))
+
+
+def remory_partition(remory: dict) -> str:
+    return partition_key(remory.get("guild_id"), remory.get("channel_id"))
+
+
+def attribute_remory_guilds() -> int:
+    """Record a guild ID on remories stored before guilds were tracked.
+
+    A remory is attributed when the bot is in a single guild or its channel
+    name is unique across the bot's guilds. Runs once per process and
+    returns the number of remories updated.
+    """
+    global _remories_attributed
+    if _remories_attributed:
+        return 0
+    _remories_attributed = True
+    guilds_by_channel = defaultdict(set)
+    for guild in bot.guilds:
+        for channel in guild.text_channels:
+            guilds_by_channel[channel.name].add(guild.id)
+    only_guild = bot.guilds[0].id if len(bot.guilds) == 1 else None
+    updated = 0
     for user in bot.user_data.values():
         for r in user.get("remory_strings", []):
-            text = r.get("context", "")
-            remories.append(strip_bot_mentions(text))
-    if not remories:
-        _index = None
-        _memories = []
+            if r.get("guild_id") is not None:
+                continue
+            candidates = guilds_by_channel.get(r.get("channel"), ())
+            guild_id = only_guild or (next(iter(candidates)) if len(candidates) == 1 else None)
+            if guild_id is not None:
+                r["guild_id"] = guild_id
+                updated += 1
+    if updated:
+        logger.info("Attributed %d legacy remories to guilds", updated)
+    return updated
+
+
+def remory_id(remory: dict) -> int:
+    """Return the stable ID of a remory.
+
+    A message stores one remory per emoji chain, so the ID is a 63-bit hash
+    of the Discord message ID and chain; legacy entries without a message
+    ID hash author, timestamp and context instead.
+    """
+    chain = "".join(remory.get("chain", []))
+    message_id = remory.get("message_id")
+    if message_id:
+        key = f"{message_id}|{chain}"
+    else:
+        key = f"{remory.get('author')}|{remory.get('timestamp')}|{remory.get('context')}|{chain}"
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def _remory_text(remory: dict) -> str:
+    return strip_bot_mentions(remory.get("context", ""))
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def content_id(text: str) -> int:
+    """Return the 63-bit FAISS ID shared by every remory with this text."""
+    digest = hashlib.blake2b(_normalize_text(text).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def _summary_id(members: Iterable[int]) -> int:
+    """Return the 63-bit FAISS ID of the summary of these content IDs."""
+    data = np.fromiter(sorted(members), dtype="int64").tobytes()
+    digest = hashlib.blake2b(b"summary\0" + data, digest_size=8).digest()
+    return int.from_bytes(digest, "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def _timestamp(value) -> float:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def _remory_meta(remory: dict) -> tuple:
+    """``(author, timestamp, chain key)`` used when ranking a remory."""
+    return (
+        remory.get("author"),
+        _timestamp(remory.get("timestamp")),
+        "".join(remory.get("chain", [])),
+    )
+
+
+def _remory_lists() -> List[list]:
+    """Shallow-copy every user's remory list, cheap enough for the event loop."""
+    return [list(user.get("remory_strings", ())) for user in bot.user_data.values()]
+
+
+def _collect_remories(
+    remory_lists: List[list], keys: Optional[Set[str]] = None
+) -> Dict[str, Dict[int, tuple]]:
+    """Group retrievable remories from :func:`_remory_lists` by partition.
+
+    Each partition maps content ID to ``(text, {remory ID: meta})``. Only
+    partitions in ``keys`` are collected when given. Normalizing and
+    hashing every remory is slow on large stores, so this runs on the
+    retrieval executor.
+    """
+    remories = defaultdict(dict)
+    for remory_strings in remory_lists:
+        for r in remory_strings:
+            if r.get("suppressed"):
+                continue
+            key = remory_partition(r)
+            if keys is not None and key not in keys:
+                continue
+            text = _remory_text(r)
+            if not text.strip():
+                continue
+            entry = remories[key].setdefault(content_id(text), (text, {}))
+            entry[1][remory_id(r)] = _remory_meta(r)
+    if keys is not None:
+        for key in keys:
+            remories.setdefault(key, {})
+    return dict(remories)
+
+
+class EmbeddingCache:
+    """Bounded LRU of embeddings keyed by a hash of model name and text.
+
+    Text is NFKC-normalized with whitespace collapsed before hashing, so the
+    same greeting or copypasta is only ever encoded once per model. Evicted
+    entries can optionally be kept in an on-disk SQLite tier. Safe to use
+    from several threads. ``model_name`` is called for the current
+    embedding space name.
+    """
+
+    def __init__(self, model_name: Callable[[], str], max_entries: int, disk_path: Optional[Path] = None):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.stats = Counter()
+        self._entries: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if disk_path is not None:
+            self._db = sqlite3.connect(str(disk_path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB)"
+            )
+
+    def key(self, text: str) -> bytes:
+        data = f"{self.model_name()}\0{_normalize_text(text)}".encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, key: bytes, record_miss: bool = True) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return vector
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype="float32")
+                    self._remember(key, vector)
+                    self.stats["disk_hits"] += 1
+                    return vector
+            if record_miss:
+                self.stats["misses"] += 1
+            return None
+
+    def put(self, items: Dict[bytes, np.ndarray]) -> None:
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, np.asarray(vector, dtype="float32"))
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, vector.tobytes()) for key, vector in items.items()],
+                )
+                self._db.commit()
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def summary(self) -> Dict[str, float]:
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hit_rate = (self.stats["hits"] + self.stats["disk_hits"]) / lookups if lookups else 0.0
+        return {
+            "entries": len(self._entries),
+            "hits": self.stats["hits"],
+            "disk_hits": self.stats["disk_hits"],
+            "misses": self.stats["misses"],
+            "encoded": self.stats["encoded"],
+            "hit_rate": hit_rate,
+        }
+
+
+# Looked up per key: the model worker only reports its name once reachable
+_embedding_cache = EmbeddingCache(
+    lambda: _backend.embedding_name,
+    EMBED_CACHE_SIZE,
+    DATA_DIR / "embedding_cache.sqlite3" if EMBED_CACHE_DISK else None,
+)
+
+
+def _embed_texts(texts: List[str]):
+    """Run the backend's embedding model, here or in the model worker."""
+    return _backend.embed(texts)
+
+
+def _encode(texts: List[str]):
+    """Embed ``texts``, encoding only distinct texts missing from the cache."""
+    keys = [_embedding_cache.key(t) for t in texts]
+    vectors: Dict[bytes, np.ndarray] = {}
+    missing: Dict[bytes, str] = {}
+    for key, text in zip(keys, texts):
+        if key in vectors or key in missing:
+            continue
+        vector = _embedding_cache.get(key)
+        if vector is None:
+            missing[key] = text
+        else:
+            vectors[key] = vector
+    if missing:
+        encoded = _embed_texts(list(missing.values()))
+        fresh = dict(zip(missing, encoded))
+        _embedding_cache.put(fresh)
+        _embedding_cache.stats["encoded"] += len(fresh)
+        vectors.update(fresh)
+    return np.stack([vectors[key] for key in keys]).astype("float32", copy=False)
+
+
+class EmbeddingQueueFull(RuntimeError):
+    """Raised when the embedding worker is too far behind to accept work."""
+
+
+class _EmbedRequest:
+    __slots__ = ("texts", "future", "enqueued")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+
+
+class EmbeddingBatcher:
+    """Background worker that embeds queued texts in micro-batches.
+
+    Requests are collected until ``max_batch`` texts are waiting or the
+    oldest has waited ``max_wait`` seconds, then embedded with a single
+    ``encode`` call on a dedicated thread. Results are delivered through
+    :class:`concurrent.futures.Future` objects. When ``max_queue`` requests
+    are already waiting, :meth:`submit` raises :class:`EmbeddingQueueFull`
+    instead of letting the backlog grow.
+    """
+
+    def __init__(self, encode, max_batch: int, max_wait: float, max_queue: int):
+        self._encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[_EmbedRequest]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.stats = Counter()
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="helmhud-embedder", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue ``texts`` for embedding and return a future of their vectors."""
+        if len(texts) == 1:
+            # Repeated queries skip the queue entirely
+            cached = _embedding_cache.get(_embedding_cache.key(texts[0]), record_miss=False)
+            if cached is not None:
+                future: Future = Future()
+                future.set_result(cached[None, :])
+                return future
+        self._ensure_started()
+        request = _EmbedRequest(list(texts))
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            self.stats["rejected"] += 1
+            raise EmbeddingQueueFull(
+                f"Embedding queue full ({self._queue.maxsize} requests waiting)"
+            ) from None
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self._queue.qsize())
+        return request.future
+
+    def embed(self, texts: List[str]):
+        """Blocking helper for worker threads; never call from the event loop."""
+        return self.submit(texts).result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            count = len(batch[0].texts)
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                count += len(request.texts)
+            self._process(batch)
+
+    def _process(self, batch: List[_EmbedRequest]) -> None:
+        batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        texts = [text for request in batch for text in request.texts]
+        try:
+            vectors = self._encode(texts)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        now = time.monotonic()
+        offset = 0
+        for request in batch:
+            request.future.set_result(vectors[offset:offset + len(request.texts)])
+            offset += len(request.texts)
+            latency = now - request.enqueued
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(batch)
+        self.stats["texts"] += len(texts)
+
+    def summary(self) -> Dict[str, float]:
+        batches = self.stats["batches"]
+        requests = self.stats["requests"]
+        return {
+            "batches": batches,
+            "avg_batch_size": self.stats["texts"] / batches if batches else 0.0,
+            "avg_latency_ms": 1000 * self._latency_total / requests if requests else 0.0,
+            "max_latency_ms": 1000 * self._latency_max,
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.stats["max_queue_depth"],
+            "rejected": self.stats["rejected"],
+        }
+
+
+_embedder = EmbeddingBatcher(_encode, EMBED_BATCH_SIZE, EMBED_BATCH_WAIT, EMBED_QUEUE_SIZE)
+
+
+async def _embed_async(texts: List[str]):
+    return await asyncio.wrap_future(_embedder.submit(texts))
+
+
+def llm_stats() -> Dict[str, Dict[str, float]]:
+    """Return runtime statistics for the LLM and memory subsystems."""
+    return {
+        "memory_index": {
+            "partitions": len(_partitions),
+            "remories": sum(len(index) for index in _partitions.values()),
+            "largest_partition": max((len(index) for index in _partitions.values()), default=0),
+            "approximate_partitions": sum(1 for index in _partitions.values() if index.kind != "flat"),
+            "pending": sum(len(p) for p in _pending_memories.values()),
+            "summaries": sum(len(index.members) for index in _partitions.values()),
+            "consolidated": sum(len(index.absorbed) for index in _partitions.values()),
+            "consolidation_runs": _consolidation_stats["runs"],
+        },
+        "lexical_index": {
+            "terms": sum(len(index.lexical.postings) for index in _partitions.values()),
+            "queries": _lexical_stats["queries"],
+            "embedding_skipped": _lexical_stats["embedding_skipped"],
+            "embedding_skip_rate": (
+                _lexical_stats["embedding_skipped"] / _lexical_stats["queries"]
+                if _lexical_stats["queries"] else 0.0
+            ),
+        },
+        "embedding_cache": _embedding_cache.summary(),
+        "embedding_batches": _embedder.summary(),
+        "generation": _generation.summary(),
+        "response_cache": _response_cache.summary(),
+        "token_counts": {"cached": len(_token_counts)},
+        **_backend.stats(),
+    }
+
+
+def _embed_into(index: MemoryIndex, entries: Dict[int, tuple]) -> None:
+    if not entries:
+        return
+    ids = list(entries)
+    texts = [entries[i][0] for i in ids]
+    index.add(ids, texts, _embedder.embed(texts))
+    for memory_id in ids:
+        index.attach(memory_id, entries[memory_id][1])
+
+
+def _load_partition(key: str) -> MemoryIndex:
+    return MemoryIndex.load(MEMORY_STORE_DIR / key) or MemoryIndex()
+
+
+def _sync_partitions(remory_lists: List[list], keys: Set[str]) -> Dict[str, Dict[int, tuple]]:
+    """Bring partitions ``keys`` in line with user data without embedding anything.
+
+    Loads each partition's persisted store on first use, drops remories that
+    no longer exist and returns the ones that still need embedding.
+    """
+    remories = _collect_remories(remory_lists, keys)
+    missing = {}
+    for key, wanted in remories.items():
+        index = _partitions.get(key)
+        if index is None:
+            index = _partitions[key] = _load_partition(key)
+        wanted = index.fold(wanted)
+        stale = [i for i in index._rows if i not in wanted]
+        index.remove(stale)
+        index.set_refs(wanted)
+        missing[key] = {i: e for i, e in wanted.items() if i not in index}
+        logger.info(
+            "Memory partition %s synced: %d stored, %d removed, %d to embed",
+            key, len(index), len(stale), len(missing[key]),
+        )
+    return missing
+
+
+def _rebuild_partitions(remory_lists: List[list]) -> None:
+    """Re-embed every remory into fresh partitions, swap them in and save them."""
+    remories = _collect_remories(remory_lists)
+    for key in set(_partitions) | set(remories):
+        index = MemoryIndex()
+        _embed_into(index, remories.get(key, {}))
+        _partitions[key] = index
+        _save_partition(key, index)
+        logger.info("Memory partition %s rebuilt with %d remories", key, len(index))
+
+
+def _add_to_partitions(items: List[Tuple[str, int, tuple]], vectors) -> None:
+    rows = defaultdict(list)
+    for n, (key, memory_id, entry) in enumerate(items):
+        rows[key].append(n)
+    for key, positions in rows.items():
+        index = _partitions[key]
+        keep = [n for n in positions if items[n][1] not in index]
+        index.add(
+            [items[n][1] for n in keep], [items[n][2][0] for n in keep], vectors[keep]
+        )
+        for n in positions:
+            index.attach(items[n][1], items[n][2][1])
+
+
+def _queue_pending(key: str, memory_id: int, entry: tuple) -> None:
+    pending = _pending_memories[key].setdefault(memory_id, (entry[0], {}))
+    pending[1].update(entry[1])
+
+
+async def _flush_pending(items: List[Tuple[str, int, tuple]]) -> None:
+    try:
+        vectors = await _embed_async([entry[0] for _, _, entry in items])
+    except EmbeddingQueueFull:
+        # Requeue and let the worker catch up before the next flush
+        for key, memory_id, entry in items:
+            _queue_pending(key, memory_id, entry)
+        await asyncio.sleep(1)
         return
-    embeddings = _emb_model.encode(remories, convert_to_numpy=True)
-    _index = faiss.IndexFlatL2(embeddings.shape[1])
-    _index.add(embeddings)
-    _memories = remories
-
-
-def get_similar(text: str, k: int = 5) -> List[str]:
-    """Return up to k memory strings most similar to text."""
-    _load_models()
-    if _index is None:
-        _build_index()
-    if _index is None or not _memories:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_retrieval_executor, _add_to_partitions, items, vectors)
+
+
+def _save_partition(key: str, index: MemoryIndex) -> Future:
+    """Snapshot a partition on the retrieval executor and write it on the save executor."""
+    snapshot = index.snapshot()
+
+    def _redirty():
+        index.dirty = index._archive_dirty = True
+
+    def _write():
+        try:
+            _write_snapshot(MEMORY_STORE_DIR / key, snapshot)
+        except Exception:
+            # Written again by the next save
+            _retrieval_executor.submit(_redirty)
+            raise
+        logger.info("Saved memory partition %s with %d remories", key, len(snapshot.get("ids", ())))
+
+    return _index_save_executor.submit(_write)
+
+
+def _save_index() -> List[Future]:
+    """Snapshot changed partitions; their files are written on the save executor."""
+    return [_save_partition(key, index) for key, index in list(_partitions.items()) if index.dirty]
+
+
+def _schedule_flush() -> None:
+    """Embed queued remories in the background, one batch at a time."""
+    global _flush_future
+    if _flush_future is not None and not _flush_future.done():
+        return
+    items = []
+    for key in list(_pending_memories):
+        # Unsynced partitions pick queued remories up from their sync
+        if key not in _synced_partitions:
+            continue
+        pending = _pending_memories[key]
+        while pending and len(items) < FLUSH_BATCH_SIZE:
+            memory_id, entry = pending.popitem()
+            items.append((key, memory_id, entry))
+        if not pending:
+            del _pending_memories[key]
+        if len(items) >= FLUSH_BATCH_SIZE:
+            break
+    if not items:
+        return
+    _flush_future = asyncio.ensure_future(_flush_pending(items))
+    _flush_future.add_done_callback(_flush_done)
+
+
+def _flush_done(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Background memory indexing failed", exc_info=future.exception())
+    _schedule_flush()
+
+
+def _sync_done(future: asyncio.Future) -> None:
+    if future.cancelled() or future.exception() is not None:
+        return
+    # Anything missing from the store is embedded incrementally in the background
+    for key, missing in future.result().items():
+        for memory_id, entry in missing.items():
+            _queue_pending(key, memory_id, entry)
+        _synced_partitions.add(key)
+    _schedule_flush()
+
+
+def add_memory(remory: dict) -> None:
+    """Queue a new remory for background embedding into its partition."""
+    if remory.get("suppressed"):
+        return
+    text = _remory_text(remory)
+    if not text.strip():
+        return
+    key = remory_partition(remory)
+    if key not in _synced_partitions and key not in _partition_syncs:
+        # Not loaded yet; its first sync reads the remory from user data
+        return
+    _queue_pending(key, content_id(text), (text, {remory_id(remory): _remory_meta(remory)}))
+    _schedule_flush()
+
+
+def forget_memories(remories: Iterable[dict]) -> None:
+    """Remove remories from retrieval, e.g. after an unregister or shield.
+
+    The remories are flagged ``suppressed`` so later syncs and rebuilds keep
+    them out of the index.
+    """
+    ids = defaultdict(list)
+    forgotten = defaultdict(set)
+    for r in remories:
+        r["suppressed"] = True
+        key = remory_partition(r)
+        ids[key].append(remory_id(r))
+        forgotten[r.get("guild_id")].add(content_id(_remory_text(r)))
+        pending = _pending_memories.get(key, {}).get(content_id(_remory_text(r)))
+        if pending is not None:
+            pending[1].pop(ids[key][-1], None)
+
+    def _remove():
+        for key, remory_ids in ids.items():
+            if key in _partitions:
+                _partitions[key].detach(remory_ids)
+
+    if ids:
+        _retrieval_executor.submit(_remove)
+    for guild_id, memory_ids in forgotten.items():
+        _response_cache.invalidate(guild_id, memory_ids)
+
+
+async def _ensure_partitions(keys: List[str]) -> None:
+    """Sync partitions with user data once each, sharing in-flight syncs."""
+    waiting = []
+    todo = set()
+    for key in keys:
+        if key in _synced_partitions:
+            continue
+        future = _partition_syncs.get(key)
+        if future is not None and not future.done():
+            waiting.append(future)
+        else:
+            todo.add(key)
+    if todo:
+        # Copy the lists on the loop so the worker never iterates live user data
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_retrieval_executor, _sync_partitions, _remory_lists(), todo)
+        future.add_done_callback(_sync_done)
+        for key in todo:
+            _partition_syncs[key] = future
+        waiting.append(future)
+    # Shield so a caller timing out doesn't cancel the sync for everyone else
+    for future in waiting:
+        await asyncio.shield(future)
+
+
+async def rebuild_index() -> int:
+    """Maintenance: re-embed every remory from scratch.
+
+    Consolidated history is expanded back into exact vectors until the
+    next consolidation. Returns the number of remories across the new
+    partitions.
+    """
+    remory_lists = _remory_lists()
+    _pending_memories.clear()
+    _response_cache.clear()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_retrieval_executor, _rebuild_partitions, remory_lists)
+    _synced_partitions.update(_partitions)
+    return sum(len(index) for index in _partitions.values())
+
+
+@tasks.loop(minutes=10)
+async def save_memory_index():
+    """Persist the memory index to DATA_DIR when it has changed"""
+    loop = asyncio.get_running_loop()
+    try:
+        futures = await loop.run_in_executor(_retrieval_executor, _save_index)
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+    except Exception as e:
+        logger.error(f"Error saving memory index: {e}")
+
+
+def _cluster(vectors, k: int):
+    """Spherical k-means: return unit centroids and each vector's cluster."""
+    import faiss
+
+    kmeans = faiss.Kmeans(vectors.shape[1], k, niter=20, seed=1234, spherical=True)
+    kmeans.train(vectors)
+    _, labels = kmeans.index.search(vectors, 1)
+    return kmeans.centroids, labels[:, 0]
+
+
+async def consolidate_partition(key: str, cutoff: Optional[float] = None) -> int:
+    """Cluster a loaded partition's old remories into summary vectors.
+
+    Remories last referenced before ``cutoff`` (default
+    ``CONSOLIDATE_AFTER_DAYS`` ago), together with earlier summaries' raw
+    vectors, are clustered with FAISS k-means into at most
+    ``CONSOLIDATE_CLUSTERS`` centroids. Each centroid replaces its members
+    in the index and is shown as the member nearest to it; newer remories
+    stay exact. Clustering runs off the retrieval executor so searches
+    carry on meanwhile. Returns the number of summaries, or 0 when there is
+    too little old history.
+    """
+    if cutoff is None:
+        cutoff = time.time() - CONSOLIDATE_AFTER_DAYS * 86400
+    index = _partitions.get(key)
+    if index is None:
+        return 0
+    loop = asyncio.get_running_loop()
+    ids, vectors = await loop.run_in_executor(
+        _retrieval_executor, index.consolidation_input, cutoff
+    )
+    if vectors is None:
+        return 0
+    started = time.monotonic()
+    k = max(1, min(CONSOLIDATE_CLUSTERS, len(ids) // CONSOLIDATE_CLUSTER_SIZE))
+    centroids, labels = await asyncio.to_thread(_cluster, vectors, k)
+    summaries = await loop.run_in_executor(
+        _retrieval_executor, index.consolidate, ids, vectors, centroids, labels, cutoff
+    )
+    _consolidation_stats["runs"] += 1
+    logger.info(
+        "Memory partition %s consolidated %d old remories into %d summaries in %.1fs",
+        key, len(ids), summaries, time.monotonic() - started,
+    )
+    return summaries
+
+
+@tasks.loop(hours=CONSOLIDATE_INTERVAL_HOURS)
+async def consolidate_memories():
+    """Fold old history in each loaded memory partition into summary vectors"""
+    if CONSOLIDATE_AFTER_DAYS <= 0:
+        return
+    # Partitions not searched since startup aren't loaded; they are
+    # consolidated on a later run once they are
+    for key in sorted(_synced_partitions):
+        try:
+            await consolidate_partition(key)
+        except Exception:
+            logger.exception("Error consolidating memory partition %s", key)
+
+
+def _lexical_search(keys: List[str], text: str, k: int) -> Tuple[Dict[str, List[Tuple[float, int]]], bool]:
+    """BM25 hits per partition, and whether they answer the query on their own.
+
+    Lexical hits are sufficient, and embedding the query can be skipped,
+    when at least ``k`` remories contain an emoji chain from the query or
+    contain every query term.
+    """
+    terms, chains = lexical_terms(text)
+    hits = {}
+    exact = set()
+    complete = 0
+    for key in keys:
+        index = _partitions.get(key)
+        if index is None or not len(index):
+            continue
+        hits[key], matched = index.lexical.search(terms, max(k, LEXICAL_CANDIDATES))
+        complete += matched
+        if chains:
+            exact.update((key, i) for i in index.lexical.matching(chains))
+    _lexical_stats["queries"] += 1
+    sufficient = len(exact) >= k or complete >= k
+    if sufficient:
+        _lexical_stats["embedding_skipped"] += 1
+    return hits, sufficient
+
+
+def _search(keys: List[str], embedding, k: int, lexical: Dict[str, List[Tuple[float, int]]]) -> List[tuple]:
+    """Return nearest and lexical candidates across partitions for re-ranking.
+
+    Each candidate is ``(distance, text, newest timestamp, authors, chains,
+    BM25 score)``; vectors are already unique per content so no text
+    appears twice. Without an ``embedding`` only lexical hits are returned,
+    at distance 2 (cosine similarity 0).
+    """
+    candidates = []
+    for key in keys:
+        index = _partitions.get(key)
+        if index is None or not len(index):
+            continue
+        bm25 = {memory_id: score for score, memory_id in lexical.get(key, ())}
+        if embedding is None:
+            nearest = {memory_id: 2.0 for memory_id in bm25}
+        else:
+            nearest = {
+                memory_id: distance
+                for distance, memory_id in index.search(embedding, max(k, RERANK_CANDIDATES))
+            }
+            for memory_id in bm25:
+                if memory_id not in nearest and memory_id in index:
+                    nearest[memory_id] = index.distance(memory_id, embedding)
+        for memory_id, distance in nearest.items():
+            # Still embedding-only if its remories were all forgotten meanwhile
+            if memory_id in index.refs:
+                candidates.append(
+                    (distance, *index.candidate(memory_id), bm25.get(memory_id, 0.0))
+                )
+    return candidates
+
+
+def rank_memories(candidates: List[tuple], k: int) -> List[str]:
+    """Blend similarity, BM25, recency, author influence and blessing; return the top k texts.
+
+    Runs on the event loop since it reads live influence scores and blessed
+    chains. Distances are squared L2 between unit vectors, so cosine
+    similarity is ``1 - d / 2``; BM25 scores are scaled to the best hit.
+    """
+    if not candidates:
         return []
-    emb = _emb_model.encode([text], convert_to_numpy=True)
-    scores, idx = _index.search(emb, k)
-    results = []
-    for i in idx[0]:
-        if 0 <= i < len(_memories):
-            results.append(_memories[i])
-    return results
-
-
-def generate_reply(prompt: str, max_tokens: int = 300) -> str:
-    """Generate a reply from the LLM for a given prompt."""
-    _load_models()
+    distances = np.fromiter((c[0] for c in candidates), dtype="float64", count=len(candidates))
+    newest = np.fromiter((c[2] for c in candidates), dtype="float64", count=len(candidates))
+    influence = np.fromiter(
+        (
+            max((bot.user_data[a]["influence_score"] for a in c[3] if a in bot.user_data), default=0)
+            for c in candidates
+        ),
+        dtype="float64",
+        count=len(candidates),
+    )
+    blessed = np.fromiter(
+        (any(chain in bot.blessed_chains for chain in c[4]) for c in candidates),
+        dtype="float64",
+        count=len(candidates),
+    )
+    bm25 = np.fromiter((c[5] for c in candidates), dtype="float64", count=len(candidates))
+    if bm25.max() > 0:
+        bm25 /= bm25.max()
+    similarity = 1.0 - distances / 2.0
+    age_days = np.clip(time.time() - newest, 0, None) / 86400.0
+    recency = np.exp2(-age_days / RANK_RECENCY_HALF_LIFE_DAYS)
+    scores = (
+        RANK_SIMILARITY_WEIGHT * similarity
+        + RANK_LEXICAL_WEIGHT * bm25
+        + RANK_RECENCY_WEIGHT * recency
+        + RANK_INFLUENCE_WEIGHT * np.tanh(influence / RANK_INFLUENCE_SCALE)
+        + RANK_BLESSED_WEIGHT * blessed
+    )
+    order = np.argsort(-scores, kind="stable")[:k]
+    return [candidates[i][1] for i in order]
+
+
+async def get_similar_async(
+    text: str,
+    k: int = 5,
+    guild_id=None,
+    channel_id=None,
+    timeout: Optional[float] = RETRIEVAL_TIMEOUT,
+    query_embedding=None,
+) -> List[str]:
+    """Return up to k ranked memory strings from the guild relevant to text.
+
+    Only the partitions for ``guild_id`` (and ``channel_id`` when indexing
+    per channel) are searched. The lexical index is consulted first; unless
+    its hits are sufficient the query is also embedded by the batching
+    worker, and all index work runs on a dedicated executor. A
+    ``query_embedding`` already computed for ``text`` (by
+    :func:`lookup_cached_reply`) is always used for ranking. If retrieval
+    takes longer than ``timeout`` seconds or fails, no memories are returned
+    and the caller carries on without them. Candidates are re-ranked by
+    :func:`rank_memories`.
+    """
+    keys = query_partitions(guild_id, channel_id)
+
+    async def _retrieve():
+        await _ensure_partitions(keys)
+        loop = asyncio.get_running_loop()
+        lexical, sufficient = await loop.run_in_executor(
+            _retrieval_executor, _lexical_search, keys, text, k
+        )
+        embedding = query_embedding
+        if embedding is None and not sufficient:
+            embedding = await _embed_async([text])
+        candidates = await loop.run_in_executor(
+            _retrieval_executor, _search, keys, embedding, k, lexical
+        )
+        return rank_memories(candidates, k)
+
+    try:
+        return await asyncio.wait_for(_retrieve(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Memory retrieval timed out after %ss; replying without memories", timeout)
+    except Exception:
+        logger.exception("Memory retrieval failed; replying without memories")
+    return []
+
+
+class ResponseCache:
+    """Replies to earlier mentions, per guild, found by query similarity.
+
+    Each entry keeps the unit query embedding, the reply, the content IDs
+    of the memories its prompt used and the divine alignment at the time.
+    Entries expire after ``ttl`` seconds, the oldest are evicted past
+    ``max_entries`` per guild, those built on a forgotten memory are
+    invalidated, and an alignment change invalidates them all. Lives on
+    the event loop.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._guilds: Dict[object, List[dict]] = {}
+        self.stats = Counter()
+
+    def _live(self, guild_id) -> List[dict]:
+        entries = self._guilds.get(guild_id, [])
+        cutoff = time.monotonic() - self.ttl
+        fresh = [e for e in entries if e["created"] >= cutoff]
+        live = [e for e in fresh if e["alignment"] == bot.divine_alignment]
+        if len(live) != len(entries):
+            self.stats["expired"] += len(entries) - len(fresh)
+            self.stats["invalidated"] += len(fresh) - len(live)
+            self._guilds[guild_id] = live
+        return live
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype="float32").reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, guild_id, embedding) -> Optional[str]:
+        entries = self._live(guild_id)
+        if entries:
+            similarity = np.stack([e["vector"] for e in entries]) @ self._unit(embedding)
+            best = int(np.argmax(similarity))
+            if similarity[best] >= self.threshold:
+                self.stats["hits"] += 1
+                return entries[best]["reply"]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, guild_id, embedding, reply: str, memories: Iterable[str]) -> None:
+        entries = self._live(guild_id)
+        entries.append({
+            "vector": self._unit(embedding),
+            "reply": reply,
+            "memories": {content_id(m) for m in memories},
+            "alignment": bot.divine_alignment,
+            "created": time.monotonic(),
+        })
+        if len(entries) > self.max_entries:
+            self.stats["evicted"] += len(entries) - self.max_entries
+            del entries[:len(entries) - self.max_entries]
+        self._guilds[guild_id] = entries
+
+    def invalidate(self, guild_id, memory_ids: Set[int]) -> None:
+        """Drop the guild's replies built on any of ``memory_ids``."""
+        entries = self._guilds.get(guild_id)
+        if not entries:
+            return
+        kept = [e for e in entries if not e["memories"] & memory_ids]
+        self.stats["invalidated"] += len(entries) - len(kept)
+        self._guilds[guild_id] = kept
+
+    def clear(self) -> None:
+        self.stats["invalidated"] += sum(len(e) for e in self._guilds.values())
+        self._guilds.clear()
+
+    def summary(self) -> Dict[str, float]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "entries": sum(len(e) for e in self._guilds.values()),
+            "hits": self.stats["hits"],
+            "misses": self.stats["misses"],
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "expired": self.stats["expired"],
+            "evicted": self.stats["evicted"],
+            "invalidated": self.stats["invalidated"],
+        }
+
+
+_response_cache = ResponseCache(RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE)
+
+
+async def lookup_cached_reply(query: str, guild_id=None):
+    """Return ``(cached reply or None, query embedding or None)`` for a mention.
+
+    The embedding is handed back so :func:`remember_reply` can store the
+    fresh reply under it. Any embedding failure is treated as a miss.
+    """
+    if not RESPONSE_CACHE or not query.strip():
+        return None, None
+    try:
+        embedding = await _embed_async([query])
+    except Exception:
+        logger.exception("Could not embed query for the response cache")
+        return None, None
+    return _response_cache.get(guild_id, embedding), embedding
+
+
+def remember_reply(guild_id, embedding, reply: str, memories: Iterable[str]) -> None:
+    """Cache a generated reply under its query embedding."""
+    if RESPONSE_CACHE and embedding is not None and reply:
+        _response_cache.put(guild_id, embedding, reply, memories)
+
+
+_token_counts: "OrderedDict[str, int]" = OrderedDict()
+_token_count_lock = threading.Lock()
+
+
+def _count_tokens_uncached(text: str) -> int:
+    return _backend.count_tokens(text)
+
+
+def truncate_tokens(text: str, limit: int) -> Tuple[str, int]:
+    """Cut ``text`` to at most ``limit`` tokens; also return its full token count."""
+    return tuple(_backend.truncate_tokens(text, limit))
+
+
+def count_tokens(text: str) -> int:
+    """Return how many tokens ``text`` takes in a prompt, cached per text."""
+    with _token_count_lock:
+        count = _token_counts.get(text)
+        if count is not None:
+            _token_counts.move_to_end(text)
+            return count
+    count = _count_tokens_uncached(text)
+    with _token_count_lock:
+        _token_counts[text] = count
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return count
+
+
+def _fit(items: List[str], budget: int, separator: int) -> Tuple[List[str], int]:
+    """Keep items in order until the next would overrun ``budget`` tokens."""
+    kept, used = [], 0
+    for item in items:
+        cost = count_tokens(item) + (separator if kept else 0)
+        if used + cost > budget:
+            break
+        kept.append(item)
+        used += cost
+    return kept, used
+
+
+def build_prompt(recent_lines: List[str], memories: List[str], query: str) -> str:
+    """Assemble a mention prompt within the configured token budgets.
+
+    ``recent_lines`` run oldest to newest and ``memories`` best first;
+    the oldest lines and lowest-ranked memories are dropped first, and an
+    over-long query is cut at its budget. Blocking: it may load the
+    tokenizer or call the model worker.
+    """
+    separator = count_tokens("\n")
+    query, query_tokens = truncate_tokens(query, PROMPT_QUERY_TOKENS)
+    query_used = min(query_tokens, PROMPT_QUERY_TOKENS)
+
+    kept_memories, memory_used = _fit(memories, PROMPT_MEMORY_TOKENS, separator)
+    spare = PROMPT_MEMORY_TOKENS - memory_used + PROMPT_QUERY_TOKENS - query_used
+    newest_first, conversation_used = _fit(
+        recent_lines[::-1], PROMPT_CONVERSATION_TOKENS + spare, separator
+    )
+    kept_lines = newest_first[::-1]
+
+    prompt = (
+        PROMPT_PREAMBLE + "\n".join(kept_lines) +
+        "\n\n### Influential Memories:\n" + "\n".join(kept_memories) +
+        "\n\n### User Query:\n" + query +
+        "\n\n### Reply:\n"
+    )
+    fixed = count_tokens(PROMPT_PREAMBLE) + count_tokens(
+        "\n\n### Influential Memories:\n\n\n### User Query:\n\n\n### Reply:\n"
+    )
+    logger.info(
+        "Prompt tokens: conversation %d (%d/%d lines), memories %d (%d/%d), "
+        "query %d of %d, ~%d total",
+        conversation_used, len(kept_lines), len(recent_lines),
+        memory_used, len(kept_memories), len(memories),
+        query_used, query_tokens,
+        fixed + conversation_used + memory_used + query_used,
+    )
+    return prompt
+
+
+def generate_reply(prompt: str, max_tokens: int = 300, on_text=None, should_stop=None) -> str:
+    """Generate a reply from the LLM for a given prompt.
+
+    Only the newly generated tokens are returned. When ``on_text`` is given
+    it is called from the generating thread with each decoded chunk as
+    soon as it is stable. Once ``should_stop`` returns True decoding ends
+    and the reply so far is returned. Blocking; runs on the model backend,
+    or in the model worker with ``HELMHUD_MODEL_WORKER`` set.
+    """
     logger.info("Generating reply from LLM")
+    return _backend.generate(prompt, max_tokens, on_text, should_stop)
+
+
+def generate_batch(
+    prompts: List[str], max_tokens: int = 300, on_texts=None, should_stop=None
+) -> List[str]:
+    """Generate replies for several prompts in one batch.
+
+    ``on_texts`` and ``should_stop`` optionally hold a streaming callback
+    and a stop check (or ``None``) per prompt, called from the generating
+    thread. A single prompt goes through :func:`generate_reply`.
+    """
+    on_texts = list(on_texts) if on_texts is not None else [None] * len(prompts)
+    should_stop = list(should_stop) if should_stop is not None else [None] * len(prompts)
+    if len(prompts) == 1:
+        return [generate_reply(prompts[0], max_tokens, on_texts[0], should_stop[0])]
+    logger.info("Generating %d replies in one batch", len(prompts))
+    return _backend.generate_batch(prompts, max_tokens, on_texts, should_stop)
+
+
+class GenerationQueueFull(RuntimeError):
+    """Raised when the generation queue, or a user's share of it, is full."""
+
+
+class GenerationMerged(Exception):
+    """Raised to a queued request superseded by a newer one from the same user."""
+
+
+class GenerationTimeout(Exception):
+    """Raised when a request runs past its deadline.
+
+    ``reply`` holds whatever was generated before the deadline, possibly
+    nothing.
+    """
+
+    def __init__(self, reply: str = ""):
+        super().__init__("Generation ran past its deadline")
+        self.reply = reply
+
+
+class _GenerationRequest:
+    __slots__ = (
+        "prompt", "max_tokens", "future", "on_text", "queued", "deadline", "stopped",
+        "user_id", "channel_id",
+    )
+
+    def __init__(
+        self,
+        prompt: str,
+        max_tokens: int,
+        future: asyncio.Future,
+        on_text=None,
+        deadline: Optional[float] = None,
+        user_id=None,
+        channel_id=None,
+    ):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.future = future
+        self.on_text = on_text
+        self.queued = time.monotonic()
+        self.deadline = deadline
+        # Set on the event loop when the caller cancels; read by the
+        # generating thread
+        self.stopped = False
+        self.user_id = user_id
+        self.channel_id = channel_id
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def should_stop(self) -> bool:
+        return self.stopped or self.expired()
+
+
+class GenerationScheduler:
+    """Run generations with bounded concurrency, a fair queue and batching.
+
+    Waiting requests are grouped by channel and served round-robin across
+    channels, oldest user first within a channel, so one busy channel or
+    user can't starve the rest. A user holds at most one waiting request
+    per channel: a newer mention replaces the prompt of the waiting one
+    (whose recent conversation it already includes) and the earlier caller
+    gets :class:`GenerationMerged`. When a slot is free, up to
+    ``batch_size`` requests are decoded together; with fewer waiting, the
+    slot is held until the oldest has waited ``batch_wait`` seconds so
+    near-simultaneous mentions share a batch.
+
+    Each request must finish within ``timeout`` seconds of being queued
+    (0 for no limit): past it, a waiting request is dropped and a running
+    one stops decoding, both raising :class:`GenerationTimeout`. A caller
+    that cancels its future stops its request the same way. While others
+    wait, new batches get a token cap shrunk from ``max_tokens`` toward
+    ``min_tokens`` in proportion to how full the queue is. Lives on the
+    event loop; generation itself runs on a dedicated thread pool.
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        max_queued: int,
+        per_user: int,
+        batch_size: int = 1,
+        batch_wait: float = 0.0,
+        timeout: float = 0.0,
+        min_tokens: int = 0,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.max_queued = max_queued
+        self.per_user = per_user
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.min_tokens = min_tokens
+        self._channels: "OrderedDict[object, OrderedDict[object, _GenerationRequest]]" = OrderedDict()
+        self._user_queued: Counter = Counter()
+        self._queued = 0
+        self._running = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.completed = 0
+        self.batches = 0
+        self.merged = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.wait_time = 0.0
+        self.token_limits = 0
+
+    def submit(
+        self, prompt: str, user_id=None, channel_id=None, max_tokens: int = 300, on_text=None
+    ) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+        users = self._channels.get(channel_id)
+        waiting = users.get(user_id) if users else None
+        if waiting is not None and not waiting.future.done():
+            waiting.future.set_exception(GenerationMerged())
+            # The superseded caller may never retrieve it
+            waiting.future.exception()
+            waiting.prompt, waiting.max_tokens, waiting.future = prompt, max_tokens, future
+            waiting.on_text, waiting.deadline = on_text, deadline
+            future.add_done_callback(lambda future: self._cancelled(waiting, future))
+            self.merged += 1
+            return future
+        if self._queued >= self.max_queued or self._user_queued[user_id] >= self.per_user:
+            self.rejected += 1
+            raise GenerationQueueFull("Generation queue is full")
+        request = _GenerationRequest(prompt, max_tokens, future, on_text, deadline, user_id, channel_id)
+        self._channels.setdefault(channel_id, OrderedDict())[user_id] = request
+        self._user_queued[user_id] += 1
+        self._queued += 1
+        future.add_done_callback(lambda future: self._cancelled(request, future))
+        self._dispatch()
+        return future
+
+    def _cancelled(self, request: _GenerationRequest, future: asyncio.Future) -> None:
+        """Stop a request whose caller cancelled it, freeing its queue slot if it was waiting."""
+        if not future.cancelled() or future is not request.future:
+            return
+        self.cancelled += 1
+        request.stopped = True
+        users = self._channels.get(request.channel_id)
+        if users is not None and users.get(request.user_id) is request:
+            del users[request.user_id]
+            if not users:
+                del self._channels[request.channel_id]
+            self._dequeued(request.user_id)
+
+    def _dequeued(self, user_id) -> None:
+        self._queued -= 1
+        self._user_queued[user_id] -= 1
+        if not self._user_queued[user_id]:
+            del self._user_queued[user_id]
+
+    def _take(self, limit: int) -> List[_GenerationRequest]:
+        """Pop up to ``limit`` live requests in fair order."""
+        batch = []
+        while self._channels and len(batch) < limit:
+            channel_id, users = self._channels.popitem(last=False)
+            user_id, request = users.popitem(last=False)
+            if users:
+                # Back of the rotation behind the other channels
+                self._channels[channel_id] = users
+            self._dequeued(user_id)
+            if request.future.done():
+                continue
+            if request.expired():
+                self.timeouts += 1
+                request.future.set_exception(GenerationTimeout())
+                continue
+            batch.append(request)
+        return batch
+
+    def _token_limit(self, max_tokens: int) -> int:
+        """Shrink ``max_tokens`` toward ``min_tokens`` as the queue fills."""
+        if not self.min_tokens or self.min_tokens >= max_tokens or not self.max_queued:
+            return max_tokens
+        load = min(1.0, self._queued / self.max_queued)
+        return round(max_tokens - (max_tokens - self.min_tokens) * load)
+
+    def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._running < self.concurrency and self._queued:
+            if self._queued < self.batch_size:
+                oldest = min(r.queued for users in self._channels.values() for r in users.values())
+                remaining = oldest + self.batch_wait - time.monotonic()
+                if remaining > 0:
+                    # Hold the slot briefly so simultaneous mentions share a batch
+                    if self._timer is None:
+                        self._timer = loop.call_later(remaining, self._window_closed)
+                    return
+            batch = self._take(self.batch_size)
+            if batch:
+                self._launch(loop, batch)
+
+    def _window_closed(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _launch(self, loop, batch: List[_GenerationRequest]) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="helmhud-generate"
+            )
+        now = time.monotonic()
+        self.wait_time += sum(now - request.queued for request in batch)
+        self.batches += 1
+        self._running += 1
+        # Replies get shorter the more requests wait behind this batch
+        max_tokens = self._token_limit(max(request.max_tokens for request in batch))
+        self.token_limits += max_tokens
+        on_texts = [
+            # Chunks arrive on the generating thread
+            (lambda text, callback=request.on_text: loop.call_soon_threadsafe(callback, text))
+            if request.on_text is not None else None
+            for request in batch
+        ]
+        task = loop.run_in_executor(
+            self._executor,
+            generate_batch,
+            [request.prompt for request in batch],
+            max_tokens,
+            on_texts,
+            [request.should_stop for request in batch],
+        )
+        task.add_done_callback(lambda task, batch=batch: self._finished(batch, task))
+
+    def _finished(self, batch: List[_GenerationRequest], task: asyncio.Future) -> None:
+        self._running -= 1
+        self.completed += len(batch)
+        error = task.exception()
+        for n, request in enumerate(batch):
+            if request.future.done():
+                continue
+            if error is not None:
+                request.future.set_exception(error)
+            elif request.expired():
+                self.timeouts += 1
+                request.future.set_exception(GenerationTimeout(task.result()[n]))
+            else:
+                request.future.set_result(task.result()[n])
+        self._dispatch()
+
+    def summary(self) -> Dict[str, float]:
+        started = self.completed + self._running
+        return {
+            "queued": self._queued,
+            "running": self._running,
+            "completed": self.completed,
+            "batches": self.batches,
+            "average_batch_size": self.completed / self.batches if self.batches else 0.0,
+            "merged": self.merged,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "average_wait_seconds": self.wait_time / started if started else 0.0,
+            "average_token_limit": self.token_limits / self.batches if self.batches else 0.0,
+        }
+
+
+_generation = GenerationScheduler(
+    GENERATION_CONCURRENCY,
+    GENERATION_QUEUE_SIZE,
+    GENERATION_USER_LIMIT,
+    GENERATION_BATCH_SIZE,
+    GENERATION_BATCH_WAIT,
+    GENERATION_TIMEOUT,
+    GENERATION_MIN_TOKENS,
+)
+
+
+async def generate_reply_async(
+    prompt: str, user_id=None, channel_id=None, max_tokens: int = 300, on_text=None
+) -> str:
+    """Generate a reply through the shared scheduler.
 
-    inputs = _tokenizer(prompt, return_tensors="pt").to(_model.device)
-    # Some models (e.g. LLaMA) don't accept token_type_ids. Ensure we never pass
-    # them to `generate` even if the tokenizer returned them.
-    gen_inputs = {k: v for k, v in inputs.items() if k != "token_type_ids"}
-    output = _model.generate(**gen_inputs, max_new_tokens=max_tokens)
-    text = _tokenizer.decode(output[0], skip_special_tokens=True)
-    text = re.sub(r"<\|end.*?>", "", text)
-    # Some models echo the entire prompt. If so, strip everything up to the
-    # explicit reply section.
-    if "### Reply:" in text:
-        text = text.split("### Reply:", 1)[1]
-    elif "Reply:" in text:
-        text = text.split("Reply:", 1)[1]
-    return text.strip()
+    ``on_text``, if given, is called on the event loop with each newly
+    decoded chunk while the reply streams. Raises
+    :class:`GenerationQueueFull` when the request can't be queued,
+    :class:`GenerationMerged` when a newer request from the same user in
+    the same channel replaced it, and :class:`GenerationTimeout` when it
+    ran past ``HELMHUD_GENERATION_TIMEOUT``. Cancelling the awaiting task
+    stops the generation.
+    """
+    return await _generation.submit(prompt, user_id, channel_id, max_tokens, on_text)
@@ -0,0 +1,356 @@
+"""Out-of-process model worker for Helmhud Guardian.
+
+Run ``python -m guardian.model_worker`` to load the model backend chosen by
+``HELMHUD_BACKEND`` (see ``guardian.backends``) once in a process of its own
+and serve it over a Unix socket. Starting the bot with
+``HELMHUD_MODEL_WORKER`` set to the same socket path makes ``guardian.llm``
+send model work there instead of loading weights itself, so the bot starts
+and restarts in seconds and generation no longer competes with the event
+loop for the GIL.
+
+Requests and replies are dicts sent over ``multiprocessing.connection``:
+
+    {"op": "ping"}                                   -> {"embedding_name": name}
+    {"op": "generate", "prompt", "max_tokens", "stream"}
+        -> {"text": chunk} while streaming, then the reply
+    {"op": "generate_batch", "prompts", "max_tokens", "stream": [bool]}
+        -> {"index": n, "text": chunk} while streaming, then the replies
+    {"op": "stop", "index": n}                       -> no reply
+    {"op": "embed", "texts"}                         -> float32 array
+    {"op": "count_tokens", "text"}                   -> int
+    {"op": "truncate_tokens", "text", "limit"}       -> (text, token count)
+    {"op": "stats"}                                  -> model statistics
+
+Results arrive as ``{"result": ...}`` and failures as ``{"error": message}``.
+A client may send ``stop`` while a generation runs to end that prompt (row
+``n`` of a batch, 0 for ``generate``) early with what it has so far.
+Memory search stays in the bot process: the FAISS partitions are built from
+the bot's user data and hold no model weights.
+"""
+
+import argparse
+import logging
+import os
+import secrets
+import stat
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from .backends import PROMPT_PREAMBLE, ModelBackend, create_backend
+from .config import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# Shared secret both sides use to authenticate connections. Messages are
+# pickled, so anyone holding it can run code on the other side; without
+# HELMHUD_MODEL_WORKER_KEY a random key is kept in DATA_DIR/model_worker.key
+WORKER_KEY = os.getenv("HELMHUD_MODEL_WORKER_KEY", "")
+# Seconds between stop checks while a client waits on a generation
+STOP_POLL_INTERVAL = 0.1
+# Seconds load() waits for an unreachable worker before reporting it
+WORKER_WAIT = float(os.getenv("HELMHUD_MODEL_WORKER_WAIT", "120"))
+
+
+class ModelWorkerError(RuntimeError):
+    """Raised when the model worker is unreachable or a request fails there."""
+
+
+_authkey = None
+_authkey_lock = threading.Lock()
+
+
+def authkey() -> bytes:
+    """Return the connection key, creating the key file on first use.
+
+    The file is created with mode 0600 by whichever of the bot and the
+    worker starts first, and refused if other users can read it.
+    """
+    global _authkey
+    with _authkey_lock:
+        if _authkey is None:
+            _authkey = WORKER_KEY.encode("utf-8") if WORKER_KEY else _read_key_file()
+        return _authkey
+
+
+def _read_key_file() -> bytes:
+    path = DATA_DIR / "model_worker.key"
+    if not path.exists():
+        # Write a private temp file and link it into place, so the other
+        # side never reads a half-written key and the first writer wins
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, path)
+            logger.info("Created model worker key %s", path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    info = os.stat(path)
+    if info.st_mode & (stat.S_IRWXG | stat.S_IRWXO) or info.st_uid != os.getuid():
+        raise ModelWorkerError(f"{path} must be owned by this user and not readable by others (chmod 600)")
+    key = path.read_text(encoding="utf-8").strip()
+    if not key:
+        raise ModelWorkerError(f"{path} is empty")
+    return key.encode("utf-8")
+
+
+class ModelWorkerClient(ModelBackend):
+    """Blocking client for the model worker, usable as the bot's backend.
+
+    Each thread gets its own connection, so generation threads, the
+    embedding worker and prompt builders never wait on each other's
+    requests. A dropped connection is re-opened on the next call.
+    """
+
+    name = "worker"
+
+    def __init__(self, address: str):
+        self.address = address
+        self._embedding_name = None
+        self._local = threading.local()
+
+    @property
+    def embedding_name(self) -> str:
+        """The embedding space of the worker's backend, asked for on first use."""
+        if self._embedding_name is None:
+            self.ping()
+        return self._embedding_name
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            try:
+                conn = Client(self.address, family="AF_UNIX", authkey=authkey())
+            except (OSError, AuthenticationError) as e:
+                raise ModelWorkerError(f"Model worker at {self.address} is unreachable: {e}") from e
+            self._local.conn = conn
+        return conn
+
+    def call(self, request: dict, on_text=None, should_stop=None):
+        """Send ``request`` and return its result.
+
+        ``should_stop`` optionally holds a stop check (or ``None``) per
+        prompt; each is polled while waiting and the worker is told to stop
+        that prompt once it returns True.
+        """
+        conn = self._connection()
+        stops = {n: stop for n, stop in enumerate(should_stop or ()) if stop is not None}
+        try:
+            conn.send(request)
+            while True:
+                # Check on every pass: streamed chunks can arrive faster
+                # than the poll interval, so poll() may never time out
+                while stops:
+                    for n, stop in list(stops.items()):
+                        if stop():
+                            conn.send({"op": "stop", "index": n})
+                            del stops[n]
+                    if conn.poll(STOP_POLL_INTERVAL):
+                        break
+                reply = conn.recv()
+                if "text" not in reply:
+                    break
+                if on_text is None:
+                    continue
+                if "index" in reply:
+                    on_text(reply["index"], reply["text"])
+                else:
+                    on_text(reply["text"])
+        except (OSError, EOFError) as e:
+            self._local.conn = None
+            conn.close()
+            raise ModelWorkerError(f"Lost connection to the model worker: {e}") from e
+        if "error" in reply:
+            raise ModelWorkerError(reply["error"])
+        return reply["result"]
+
+    def ping(self) -> dict:
+        reply = self.call({"op": "ping"})
+        self._embedding_name = reply["embedding_name"]
+        return reply
+
+    def load(self) -> None:
+        """Wait for the worker, which loads the models in its own process.
+
+        Raises :class:`ModelWorkerError` if it is still unreachable after
+        ``WORKER_WAIT`` seconds.
+        """
+        deadline = time.monotonic() + WORKER_WAIT
+        delay = 1
+        while True:
+            try:
+                self.ping()
+                logger.info("Using the model worker at %s", self.address)
+                return
+            except ModelWorkerError as e:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise
+                delay = min(delay, remaining)
+                logger.warning("%s; retrying in %.0fs", e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def generate(self, prompt: str, max_tokens: int = 300, on_text=None, should_stop=None) -> str:
+        request = {"op": "generate", "prompt": prompt, "max_tokens": max_tokens, "stream": on_text is not None}
+        return self.call(request, on_text, [should_stop])
+
+    def generate_batch(self, prompts, max_tokens: int = 300, on_texts=None, should_stop=None):
+        on_texts = list(on_texts) if on_texts is not None else [None] * len(prompts)
+        request = {
+            "op": "generate_batch",
+            "prompts": list(prompts),
+            "max_tokens": max_tokens,
+            "stream": [callback is not None for callback in on_texts],
+        }
+
+        def on_text(index, text):
+            if on_texts[index] is not None:
+                on_texts[index](text)
+
+        return self.call(request, on_text, should_stop)
+
+    def embed(self, texts):
+        return self.call({"op": "embed", "texts": list(texts)})
+
+    def count_tokens(self, text: str) -> int:
+        return self.call({"op": "count_tokens", "text": text})
+
+    def truncate_tokens(self, text: str, limit: int):
+        return tuple(self.call({"op": "truncate_tokens", "text": text, "limit": limit}))
+
+    def stats(self) -> dict:
+        try:
+            return {"model_worker": {"reachable": 1}, **self.call({"op": "stats"})}
+        except ModelWorkerError:
+            return {"model_worker": {"reachable": 0}}
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client(address: str) -> ModelWorkerClient:
+    """Return the shared client for ``address``."""
+    with _clients_lock:
+        if address not in _clients:
+            _clients[address] = ModelWorkerClient(address)
+        return _clients[address]
+
+
+def _handle(conn, backend: ModelBackend) -> None:
+    """Serve one bot connection until it closes."""
+    stopped = set()
+
+    def stop_requested(n: int) -> bool:
+        # The client sends stops while its generation runs
+        while conn.poll():
+            message = conn.recv()
+            if message.get("op") == "stop":
+                stopped.add(message.get("index", 0))
+        return n in stopped
+
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                return
+            op = request.get("op")
+            if op == "stop":
+                # Arrived after its generation finished
+                continue
+            stopped.clear()
+            try:
+                if op == "ping":
+                    result = {"embedding_name": backend.embedding_name}
+                elif op == "generate":
+                    on_text = (lambda text: conn.send({"text": text})) if request.get("stream") else None
+                    result = backend.generate(
+                        request["prompt"], request.get("max_tokens", 300), on_text, lambda: stop_requested(0)
+                    )
+                elif op == "generate_batch":
+                    on_texts = [
+                        (lambda text, n=n: conn.send({"index": n, "text": text})) if stream else None
+                        for n, stream in enumerate(request["stream"])
+                    ]
+                    should_stop = [(lambda n=n: stop_requested(n)) for n in range(len(request["prompts"]))]
+                    result = backend.generate_batch(
+                        request["prompts"], request.get("max_tokens", 300), on_texts, should_stop
+                    )
+                elif op == "embed":
+                    result = backend.embed(request["texts"])
+                elif op == "count_tokens":
+                    result = backend.count_tokens(request["text"])
+                elif op == "truncate_tokens":
+                    result = backend.truncate_tokens(request["text"], request["limit"])
+                elif op == "stats":
+                    result = backend.stats()
+                else:
+                    raise ValueError(f"Unknown model worker op {op!r}")
+            except Exception as e:
+                logger.exception("Model worker %s request failed", op)
+                reply = {"error": f"{type(e).__name__}: {e}"}
+            else:
+                reply = {"result": result}
+            try:
+                conn.send(reply)
+            except OSError:
+                return
+
+
+def serve(address: str, backend_name: str = "huggingface") -> None:
+    """Load the models and serve requests on the Unix socket ``address``."""
+    backend = create_backend(backend_name, PROMPT_PREAMBLE)
+    started = time.perf_counter()
+    backend.load()
+    logger.info("Models ready (%s) in %.1fs", backend.name, time.perf_counter() - started)
+    if os.path.exists(address):
+        os.unlink(address)
+    key = authkey()
+    # Only this user may connect: the socket is created 0600
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family="AF_UNIX", authkey=key)
+    finally:
+        os.umask(umask)
+    with listener:
+        logger.info("Model worker listening on %s", address)
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                logger.warning("Rejected a model worker connection with the wrong key")
+                continue
+            threading.Thread(
+                target=_handle, args=(conn, backend), name="helmhud-model-conn", daemon=True
+            ).start()
+
+
+def main() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s:%(name)s: %(message)s",
+    )
+    parser = argparse.ArgumentParser(description="Serve Helmhud Guardian's models over a Unix socket")
+    parser.add_argument(
+        "--address",
+        default=os.getenv("HELMHUD_MODEL_WORKER") or str(DATA_DIR / "model_worker.sock"),
+        help="Socket path (default: HELMHUD_MODEL_WORKER or DATA_DIR/model_worker.sock)",
+    )
+    parser.add_argument(
+        "--backend",
+        default=os.getenv("HELMHUD_BACKEND", "huggingface").lower(),
+        help="Model backend to serve (default: HELMHUD_BACKEND or huggingface)",
+    )
+    args = parser.parse_args()
+    serve(args.address, args.backend)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,15 @@ import discord
 from .bot import bot
 import logging
 import asyncio
+import bisect
 import re
 import emoji
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 import random
 import json
 import io
 from typing import Optional, List, Tuple
-from PIL import Image
-import magic
-import bleach
 import time
 from .config import ROLES_CONFIG, DEFAULT_STARLOCKS, DEFAULT_TRAINING_QUESTS
 
@@ -36,6 +35,76 @@ def strip_all_mentions(text: str) -> str:
     return text.strip()
 
 
+class RecentMessageBuffer:
+    """Bounded per-channel buffer of recent non-bot messages.
+
+    Fed from the gateway events so the LLM prompt can reuse conversation
+    context the bot has already seen instead of fetching channel history on
+    every mention. History is only needed to prime a channel on cold start.
+    """
+
+    def __init__(self, maxlen: int = 20):
+        self.maxlen = maxlen
+        self._channels = {}
+        self._primed = set()
+
+    @staticmethod
+    def _entry(message):
+        return (
+            message.id,
+            message.author.display_name,
+            strip_all_mentions(message.clean_content),
+        )
+
+    def add(self, message):
+        """Append ``message`` to its channel's buffer."""
+        buffer = self._channels.get(message.channel.id)
+        if buffer is None:
+            buffer = self._channels[message.channel.id] = deque(maxlen=self.maxlen)
+        buffer.append(self._entry(message))
+
+    def edit(self, channel_id: int, message_id: int, content: str):
+        """Replace the buffered text of an edited message with its raw ``content``."""
+        buffer = self._channels.get(channel_id, ())
+        for i, entry in enumerate(buffer):
+            if entry[0] == message_id:
+                buffer[i] = (message_id, entry[1], strip_all_mentions(content))
+                return
+
+    def delete(self, channel_id: int, message_id: int):
+        """Forget a deleted message."""
+        buffer = self._channels.get(channel_id)
+        if not buffer:
+            return
+        for entry in buffer:
+            if entry[0] == message_id:
+                buffer.remove(entry)
+                return
+
+    def prime(self, channel_id: int, messages):
+        """Seed a channel's buffer from fetched history."""
+        entries = {entry[0]: entry for entry in self._channels.get(channel_id, ())}
+        for message in messages:
+            entries.setdefault(message.id, self._entry(message))
+        ordered = sorted(entries.values(), key=lambda entry: entry[0])
+        self._channels[channel_id] = deque(ordered, maxlen=self.maxlen)
+        self._primed.add(channel_id)
+
+    def lines(self, channel_id: int, before_id: int, limit: int = 5) -> Optional[List[str]]:
+        """Return up to ``limit`` ``"name: text"`` lines older than ``before_id``.
+
+        Returns ``None`` on a cold start, when the buffer holds fewer than
+        ``limit`` messages and the channel history has not been fetched yet.
+        """
+        entries = [e for e in self._channels.get(channel_id, ()) if e[0] < before_id]
+        if len(entries) < limit and channel_id not in self._primed:
+            return None
+        return [f"{name}: {text}" for _, name, text in entries[-limit:]]
+
+
+recent_messages = RecentMessageBuffer()
+
+
 def extract_emojis(text):
     """Extract all Unicode and custom Discord emojis from ``text`` preserving order."""
     custom_pattern = r"<a?:\w+?:\d+>"
@@ -180,6 +249,151 @@ def calculate_chain_influence(chain, author_id, bot):
             
     return base_influence
 
+class MemberNameIndex:
+    """Lowercase username/display name lookup for the members of one guild.
+
+    Names are kept in a sorted array of ``(name, member_id)`` pairs so exact
+    and prefix lookups are a bisect, and a trigram index narrows substring
+    matches down to a handful of candidates instead of scanning the guild.
+    """
+
+    def __init__(self, members=()):
+        self._names = {}
+        self._sorted = []
+        self._trigrams = defaultdict(set)
+        # Bulk build: sort once rather than insort per name, which is
+        # quadratic on large guilds
+        for member in members:
+            self._names[member.id] = self._member_names(member)
+        for member_id, names in self._names.items():
+            for name in names:
+                self._sorted.append((name, member_id))
+                for gram in self._grams(name):
+                    self._trigrams[gram].add(member_id)
+        self._sorted.sort()
+
+    def __len__(self):
+        return len(self._names)
+
+    @staticmethod
+    def _member_names(member):
+        return tuple(sorted({member.name.lower(), member.display_name.lower()}))
+
+    @staticmethod
+    def _grams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, member):
+        """Index ``member`` or refresh its names if they changed."""
+        names = self._member_names(member)
+        if self._names.get(member.id) == names:
+            return
+        self.remove(member.id)
+        self._names[member.id] = names
+        for name in names:
+            bisect.insort(self._sorted, (name, member.id))
+            for gram in self._grams(name):
+                self._trigrams[gram].add(member.id)
+
+    def remove(self, member_id):
+        """Drop ``member_id`` from the index if present."""
+        names = self._names.pop(member_id, None)
+        if not names:
+            return
+        for name in names:
+            i = bisect.bisect_left(self._sorted, (name, member_id))
+            if i < len(self._sorted) and self._sorted[i] == (name, member_id):
+                del self._sorted[i]
+            for gram in self._grams(name):
+                ids = self._trigrams.get(gram)
+                if ids is not None:
+                    ids.discard(member_id)
+                    if not ids:
+                        del self._trigrams[gram]
+
+    def prefix(self, prefix, exact=False):
+        """Return member IDs whose name starts with (or equals) ``prefix``."""
+        results = []
+        seen = set()
+        i = bisect.bisect_left(self._sorted, (prefix,))
+        while i < len(self._sorted):
+            name, member_id = self._sorted[i]
+            if not name.startswith(prefix) or (exact and name != prefix):
+                break
+            if member_id not in seen:
+                seen.add(member_id)
+                results.append(member_id)
+            i += 1
+        return results
+
+    def substring(self, fragment):
+        """Return member IDs whose name contains ``fragment``."""
+        if len(fragment) < 3:
+            candidates = self._names.keys()
+        else:
+            grams = sorted(self._grams(fragment), key=lambda g: len(self._trigrams.get(g, ())))
+            candidates = set(self._trigrams.get(grams[0], ()))
+            for gram in grams[1:]:
+                if not candidates:
+                    break
+                candidates &= self._trigrams.get(gram, set())
+        return sorted(
+            member_id for member_id in candidates
+            if any(fragment in name for name in self._names[member_id])
+        )
+
+    def lookup(self, reference):
+        """Return the best matching member ID for ``reference`` or ``None``.
+
+        Exact matches win over prefix matches, which win over substrings.
+        """
+        reference = reference.lower()
+        if not reference:
+            return None
+        for ids in (
+            self.prefix(reference, exact=True),
+            self.prefix(reference),
+            self.substring(reference),
+        ):
+            if ids:
+                return ids[0]
+        return None
+
+
+_member_indexes = {}
+
+
+def get_member_index(guild):
+    """Return the name index for ``guild``, building it on first use."""
+    index = _member_indexes.get(guild.id)
+    if index is None:
+        index = MemberNameIndex(guild.members)
+        _member_indexes[guild.id] = index
+    return index
+
+
+def index_member(member):
+    """Refresh ``member`` in its guild's name index if one has been built."""
+    index = _member_indexes.get(member.guild.id)
+    if index is not None:
+        index.add(member)
+
+
+def unindex_member(member):
+    """Remove ``member`` from its guild's name index if one has been built."""
+    index = _member_indexes.get(member.guild.id)
+    if index is not None:
+        index.remove(member.id)
+
+
+def find_member_by_name(guild, reference: str):
+    """Find a member of ``guild`` by username or display name."""
+    member_id = get_member_index(guild).lookup(reference)
+    if member_id is None:
+        return None
+    return guild.get_member(member_id)
+
+
 async def get_member_by_reference(ctx, reference: str):
     """Get a member by ID, username, or display name without mentioning"""
     # Try as user ID
@@ -192,15 +406,7 @@ async def get_member_by_reference(ctx, reference: str):
         pass
     
     # Try as username or display name
-    reference_lower = reference.lower()
-    for member in ctx.guild.members:
-        if (member.name.lower() == reference_lower or 
-            member.display_name.lower() == reference_lower or
-            reference_lower in member.name.lower() or
-            reference_lower in member.display_name.lower()):
-            return member
-    
-    return None
+    return find_member_by_name(ctx.guild, reference)
 async def fetch_history_batched(channel, limit=None, batch_size=100, base_delay=0.2, start_before=None, progress_callback=None):
     """Yield channel history in batches with adaptive delays for rate limits.
 
@@ -587,6 +793,14 @@ async def unregister_chain(chain_key, reason="unspecified", by_user_id=None):
     # Remove from blessed chains if blessed
     if chain_key in bot.blessed_chains:
         del bot.blessed_chains[chain_key]
+
+    # Drop the chain's remories from LLM memory retrieval
+    from .llm import forget_memories
+    forget_memories(
+        r for user_data in bot.user_data.values()
+        for r in user_data.get("remory_strings", [])
+        if "".join(r.get("chain", [])) == chain_key
+    )
     
     # Log unregistration
     logger.info(
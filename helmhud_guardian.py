@@ -4,8 +4,9 @@
 import os
 import logging
 from dotenv import load_dotenv
-from guardian import bot
-from guardian.llm import ensure_model_downloaded
+from guardian.bot import bot
+# Importing these registers the bot's events, commands and LLM tasks
+from guardian import utils, events, commands, llm  # noqa: F401
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,5 +21,4 @@ if __name__ == "__main__":
         raise RuntimeError(
             "DISCORD_TOKEN not set. Create a .env file with DISCORD_TOKEN=your_token"
         )
-    ensure_model_downloaded()
     bot.run(token)